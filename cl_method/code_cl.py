@@ -1,12 +1,90 @@
 from models.conceptor_operations import *
+from models.conceptor_eigen import *
 import torch
 import logging
 
-__all__ = ["update_basis"]
+# Maximum number of values of the unfolded/padded blocks used to process conv layer inputs
+MAX_BLOCK_ELEMENTS = 2 ** 24
 
+__all__ = ["update_basis", "CorrelationAccumulator"]
 
-def update_basis(mat_list, threshold=[0.95, 0.99, 0.99], conceptor_list=[], aperture=[8, 8, 8, 16, 16, 16],
-                 model_name="AlexNet", memory_threshold=0.95, lower_sval_bound=0.2, print_logs=True):
+
+def layer_activation(mat, kernel_size=None, stride=1, padding=0):
+    """
+    Arranges the input of a layer as a (d, N) matrix, one sample (or conv patch) per column
+    """
+    if len(mat.size()) == 4:
+        data_x = mat
+        x_unf = torch.nn.functional.unfold(data_x,
+                                           kernel_size=(kernel_size, kernel_size),
+                                           stride=(stride, stride),
+                                           padding=(padding, padding))
+        x_unf = x_unf.permute(0, 2, 1).contiguous()
+        return x_unf.view(-1, x_unf.size(2)).T
+    return mat.T
+
+
+def patch_correlation(x, kernel_size, stride=1, padding=0, max_elements=MAX_BLOCK_ELEMENTS):
+    """
+    Sum of p p^T over all the conv patches p of x (N, C, H, W), with the feature order of torch.nn.functional.unfold
+    (channel, kernel row, kernel column). Instead of materializing the (C k^2, N H' W') unfolded matrix, every pair of
+    kernel offsets contributes the inner products of two strided views of the padded input. Samples are processed in
+    chunks whose k^2 shifted views, gathered once into a (k^2, C, n H' W') buffer, hold at most max_elements values.
+    :return: (C k^2, C k^2) matrix, number of patches
+    """
+    N, C, H, W = x.size()
+    k = kernel_size
+    h_out = (H + 2 * padding - k) // stride + 1
+    w_out = (W + 2 * padding - k) // stride + 1
+    chunk = max(1, max_elements // (C * k * k * h_out * w_out))
+    R = torch.zeros(C, k * k, C, k * k, device=x.device, dtype=x.dtype)
+    for n in range(0, N, chunk):
+        x_pad = torch.nn.functional.pad(x[n:n + chunk], (padding, padding, padding, padding))
+        shifts = x_pad.new_empty(k * k, C, x_pad.size(0), h_out, w_out)
+        for i in range(k):
+            for j in range(k):
+                shifts[i * k + j] = x_pad[:, :, i:i + stride * (h_out - 1) + 1:stride,
+                                          j:j + stride * (w_out - 1) + 1:stride].transpose(0, 1)
+        shifts = shifts.view(k * k, C, -1)
+        for a in range(k * k):
+            for b in range(a, k * k):
+                AB = torch.matmul(shifts[a], shifts[b].T)
+                R[:, a, :, b] += AB
+                if b != a:
+                    R[:, b, :, a] += AB.T
+    return R.view(C * k * k, C * k * k), N * h_out * w_out
+
+
+class ConvPatches(object):
+    """
+    Columns of the unfolded input of a conv layer, produced in blocks of samples (at most max_elements values per
+    block) when iterated, so that the full unfolded matrix is never allocated.
+    """
+
+    def __init__(self, x, kernel_size, stride=1, padding=0, max_elements=MAX_BLOCK_ELEMENTS):
+        self.x = x
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.max_elements = max_elements
+        N, C, H, W = x.size()
+        h_out = (H + 2 * padding - kernel_size) // stride + 1
+        w_out = (W + 2 * padding - kernel_size) // stride + 1
+        self.chunk = max(1, max_elements // (C * kernel_size * kernel_size * h_out * w_out))
+
+    def __iter__(self):
+        for n in range(0, self.x.size(0), self.chunk):
+            yield layer_activation(self.x[n:n + self.chunk], self.kernel_size, self.stride, self.padding)
+
+    def correlation(self):
+        R, count = patch_correlation(self.x, self.kernel_size, self.stride, self.padding, self.max_elements)
+        return R / count
+
+
+def layer_config(model_name):
+    """
+    Kernel size, stride and padding of the conv layers of each model, in the order of forward_all_layers
+    """
     if model_name == 'ResNet18':
         kernel_list = [3, 3, 3, 3, 3, 3, 1, 3, 3, 3, 3, 1, 3, 3, 3, 3, 1, 3, 3, 3]
         stride_list = [1, 1, 1, 1, 1, 2, 2, 1, 1, 1, 2, 2, 1, 1, 1, 2, 2, 1, 1, 1]
@@ -16,76 +94,123 @@ def update_basis(mat_list, threshold=[0.95, 0.99, 0.99], conceptor_list=[], aper
         stride_list = [1, 1, 1]
         padding_list = [0, 0, 0]
     elif model_name == 'MLP':
-        pass
+        kernel_list, stride_list, padding_list = [], [], []
     else:
         raise NotImplementedError(f"{model_name} has not been implemented")
-    if not conceptor_list:
-        # After First Task
+    return kernel_list, stride_list, padding_list
+
+
+class CorrelationAccumulator(object):
+    """
+    Running sums of X X^T (float64) and of the number of columns of every layer input, so that conceptors can be
+    built from any number of batches while only one batch of activations is alive at a time.
+    """
+
+    def __init__(self, model_name="AlexNet", device=None):
+        self.kernel_list, self.stride_list, self.padding_list = layer_config(model_name)
+        self.device = device
+        self.sums = []
+        self.counts = []
+
+    def update(self, mat_list):
+        if self.device is not None:
+            mat_list = [x.to(self.device, non_blocking=True) for x in mat_list]
         for i in range(len(mat_list)):
             if len(mat_list[i].size()) == 4:
-                data_x = mat_list[i].cuda()
-                x_unf = torch.nn.functional.unfold(data_x,
-                                                   kernel_size=(kernel_list[i], kernel_list[i]),
-                                                   stride=(stride_list[i], stride_list[i]),
-                                                   padding=(padding_list[i], padding_list[i]))
-                x_unf = x_unf.permute(0, 2, 1).contiguous()
-                activation = x_unf.view(-1, x_unf.size(2)).T
+                xxt, count = patch_correlation(mat_list[i], self.kernel_list[i], self.stride_list[i],
+                                               self.padding_list[i])
             else:
-                activation = mat_list[i].cuda().T
-            flag = True
-            gain = 1.1
-            C = compute_conceptor(activation, aperture=aperture[i])
-            while flag:
-                ratio = torch.norm(torch.matmul(C, activation), dim=0).sum() / torch.norm(activation,
-                                                                                          dim=0).sum()
-                if ratio < memory_threshold:
-                    C = aperture_adaptation(C, gain)
-                else:
-                    flag = False
-            if lower_sval_bound > 0:
-                UC, SC, UtC = torch.svd(C)
-                SC[SC < lower_sval_bound] = 0
-                C = torch.matmul(UC, torch.matmul(torch.diag(SC), UC.T))
-            conceptor_list.append(C.cuda())
-    else:
-        for i in range(len(mat_list)):
-            if len(mat_list[i].size()) == 4:
-                data_x = mat_list[i].cuda()
-                x_unf = torch.nn.functional.unfold(data_x,
-                                                   kernel_size=(kernel_list[i], kernel_list[i]),
-                                                   stride=(stride_list[i], stride_list[i]),
-                                                   padding=(padding_list[i], padding_list[i]))
-                x_unf = x_unf.permute(0, 2, 1).contiguous()
-                activation = x_unf.view(-1, x_unf.size(2)).T
+                activation = layer_activation(mat_list[i])
+                xxt, count = torch.matmul(activation, activation.T), activation.size(1)
+            if i < len(self.sums):
+                self.sums[i] += xxt.double()
+                self.counts[i] += count
             else:
-                activation = mat_list[i].cuda().T
-            C = conceptor_list[i]
-            flag = True
-            gain = 1.1
-            B = compute_conceptor(activation, aperture=aperture[i])
-            while flag:
-                ratio = torch.norm(torch.matmul(B, activation), dim=0).sum() / torch.norm(activation,
-                                                                                          dim=0).sum()
-                if ratio < memory_threshold:
-                    B = aperture_adaptation(B, gain)
-                else:
-                    flag = False
-            C = or_operation(C, B, aperture=aperture[i])
-            if lower_sval_bound > 0:
-                UC, SC, UtC = torch.svd(C)
-                SC[SC < lower_sval_bound] = 0
-                C = torch.matmul(UC, torch.matmul(torch.diag(SC), UC.T))
-            conceptor_list[i] = C
+                self.sums.append(xxt.double())
+                self.counts.append(count)
+
+    def correlation(self):
+        return [s / n for s, n in zip(self.sums, self.counts)]
+
+
+def update_basis(mat_list, threshold=[0.95, 0.99, 0.99], conceptor_list=[], aperture=[8, 8, 8, 16, 16, 16],
+                 model_name="AlexNet", memory_threshold=0.95, lower_sval_bound=0.2, print_logs=True,
+                 correlation=None, device=None):
+    """
+    Builds (first task) or extends the conceptor of every layer from its input activations, mat_list. If correlation
+    (the output of CorrelationAccumulator.correlation) is given, the conceptors are computed from it and mat_list is
+    only used to check the reconstruction ratio of the aperture search. The conceptors are computed on device (the
+    device of mat_list if None).
+    """
+    kernel_list, stride_list, padding_list = layer_config(model_name)
+    if device is not None:
+        mat_list = [x.to(device, non_blocking=True) for x in mat_list]
+    # Conceptors are handled in eigen form (see models/conceptor_eigen.py), so the aperture loop, the OR with the
+    # previous conceptor and the singular value bound are spectral maps instead of repeated SVDs/inverses
+    first_task = not conceptor_list
+    activations = []
+    correlations = []
+    for i in range(len(mat_list)):
+        R = None if correlation is None else correlation[i]
+        if len(mat_list[i].size()) == 4:
+            # Conv inputs are never unfolded as a whole: implicit patch correlation, patches in blocks for the ratio
+            activation = ConvPatches(mat_list[i], kernel_list[i], stride_list[i], padding_list[i])
+            if R is None:
+                R = activation.correlation()
+        else:
+            activation = layer_activation(mat_list[i])
+            if R is None:
+                R = torch.matmul(activation, activation.T) / activation.size(1)
+        activations.append(activation)
+        correlations.append(R.to(device=mat_list[i].device, dtype=mat_list[i].dtype))
+
+    # Layers whose conceptors have the same size are updated together: one batched eigh for the correlations, one for
+    # the previous conceptors and the batched OR/lower bound on the stacked eigen forms
+    groups = {}
+    for i in range(len(correlations)):
+        groups.setdefault((correlations[i].size(0), correlations[i].device), []).append(i)
+    new_conceptors = [None] * len(mat_list)
+    spectra = [None] * len(mat_list)
+    search_logs = [None] * len(mat_list)
+    for idx in groups.values():
+        lam, U = torch.linalg.eigh(torch.stack([correlations[i] for i in idx]))
+        B = []
+        for j, i in enumerate(idx):
+            # Smallest aperture * gain**k meeting memory_threshold, found on the spectrum of the correlation matrix
+            B_i, steps, rounds = aperture_search(activations[i], aperture[i], memory_threshold, gain=1.1,
+                                                 eig=(lam[j], U[j]))
+            B.append(B_i)
+            search_logs[i] = (steps, rounds)
+        B = EigenConceptor.stack(B)
+        if first_task:
+            # After First Task
+            C = B
+        else:
+            C = EigenConceptor.from_matrix(torch.stack([conceptor_list[i].matrix() for i in idx])).or_operation(B)
+        if lower_sval_bound > 0:
+            C = C.lower_bound(lower_sval_bound)
+        for j, i in enumerate(idx):
+            spectra[i] = C.s[j].abs()
+            # Only the non-zero part of the spectrum is kept for the gradient projection
+            new_conceptors[i] = FactoredConceptor.from_eigen(C[j])
+    if first_task:
+        conceptor_list.extend(new_conceptors)
+    else:
+        conceptor_list[:] = new_conceptors
 
     if print_logs:
         logging.info('-' * 40)
         logging.info('Conceptors Summary')
         logging.info('-' * 40)
         for i in range(len(conceptor_list)):
-            S_conceptor = torch.linalg.svdvals(conceptor_list[i])
+            S_conceptor = spectra[i]
             logging.info('Layer {} : {:.3f}% \t max_val = {:.3f} \t min_val = {:.3f} \t # directions = {:.3f}/{}'.format(
                 i + 1,
-                100 * measure_conceptor_capacity(conceptor_list[i]),
+                100 * S_conceptor.mean(),
                 torch.max(S_conceptor), torch.min(S_conceptor), torch.sum(S_conceptor>1e-4), len(S_conceptor)))
         logging.info('-' * 40)
-    return conceptor_list
\ No newline at end of file
+        for i, (steps, rounds) in enumerate(search_logs):
+            logging.info('Layer {} : aperture x{:.3f} after {} gain steps \t {} loop iterations replaced by {} search rounds'.format(
+                i + 1, 1.1 ** steps, steps, steps + 1, rounds))
+        logging.info('-' * 40)
+    return conceptor_list
@@ -0,0 +1,48 @@
+import torch
+from torch.optim import Optimizer
+
+__all__ = ["ConceptorSGD"]
+
+
+class ConceptorSGD(Optimizer):
+    """
+    SGD (without momentum and weight decay, as used by MyStrategy) that applies the conceptor gradient projection inside
+    the update step. The weight of every registered layer (CustomLinear/CustomConv2d) is updated with its projected
+    gradient, W <- W - lr * (G - G C), as a multi-tensor SGD step followed by one fused W += lr * G C per layer, with C
+    read from the layer's basis_in (layers without conceptor yet are not projected). While projecting, the frozen
+    parameters (the BatchNorm ones) are skipped instead of having their gradients cleared.
+    :param params: parameters to optimize
+    :param lr: learning rate
+    :param conceptor_layers: layers whose weight gradient is projected by basis_in
+    :param frozen: parameters not updated while projecting
+    :param project: apply the projection (False on the first task, where there is no conceptor yet)
+    """
+
+    def __init__(self, params, lr, conceptor_layers=(), frozen=(), project=True):
+        super(ConceptorSGD, self).__init__(params, dict(lr=lr))
+        self.conceptor_layers = {id(layer.weight): layer for layer in conceptor_layers}
+        self.frozen = set(id(p) for p in frozen)
+        self.project = project
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            params, grads, projected = [], [], []
+            for p in group['params']:
+                if p.grad is None or (self.project and id(p) in self.frozen):
+                    continue
+                params.append(p)
+                grads.append(p.grad)
+                if self.project and id(p) in self.conceptor_layers:
+                    projected.append(p)
+            if params:
+                torch._foreach_add_(params, grads, alpha=-group['lr'])
+            for p in projected:
+                basis_in = self.conceptor_layers[id(p)].basis_in
+                if basis_in is not None:
+                    basis_in.addmm_(p.view(p.size(0), -1), p.grad.view(p.size(0), -1), alpha=group['lr'])
+        return loss
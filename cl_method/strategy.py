@@ -1,14 +1,16 @@
 import torch
 import torch.optim as optim
 from avalanche.evaluation.metrics import Forgetting
-from torch.utils.data import DataLoader
+from torch.utils.data import ConcatDataset, DataLoader
 from utils.metrics import *
+from utils.device_data import DataLoaderManager, DeviceDataLoader, DeviceTensorDataset
 import time
 import mlflow
 import logging
 from copy import deepcopy
 from models.nn_models import BaseModel
 from cl_method import code_cl
+from cl_method.conceptor_sgd import ConceptorSGD
 
 __all__ = ["MyStrategy", "average_forgetting_metric"]
 
@@ -17,7 +19,9 @@ class MyStrategy():
     def __init__(self, model:BaseModel, optimizer, criterion, epochs, batch_size, threshold=[0.95, 0.99, 0.99], lr=0.1,
                  aperture=4, dropout=False, data_aug=False, basis_bs=125, avg_pool=False,
                  transform_test=None, transform_train=None, dataset_name=None, model_name=None, print_freq=50,
-                 aperture_gain=1.0, patience=6, lr_decay=2, lr_threshold=1e-5, lower_bound=0.2):
+                 aperture_gain=1.0, patience=6, lr_decay=2, lr_threshold=1e-5, lower_bound=0.2, basis_batches=1,
+                 device='cuda', conceptor_device=None, grad_hooks=False, weight_cache_mb=0, amp=None,
+                 compile_step=False, augment=None):
         self.model = model
         self.optimizer = optimizer
         self.loss_fn = criterion
@@ -44,6 +48,45 @@ class MyStrategy():
         self.lr_decay = lr_decay
         self.lr_threshold = lr_threshold
         self.lower_bound = lower_bound
+        self.basis_batches = basis_batches
+        # Training device, and device used for the conceptor computations (the training device by default)
+        self.device = torch.device(device)
+        self.conceptor_device = self.device if conceptor_device is None else torch.device(conceptor_device)
+        # Persistent (pinned, prefetched on CUDA) loaders of the datasets in use
+        self.loaders = DataLoaderManager(self.device)
+        # Project the gradients with backward hooks, overlapping the projection with the backward pass
+        self.grad_hooks = grad_hooks
+        # Cache of the per-task folded weights used at evaluation (disabled when 0)
+        if weight_cache_mb > 0:
+            self.model.enable_weight_cache(int(weight_cache_mb * 2 ** 20))
+        # Mixed precision ('bf16' or 'fp16') of the training forward/backward passes, the conceptors and the gradient
+        # projection stay in fp32
+        self.amp_dtype = {None: None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[amp]
+        # Training step compiled with CUDA graphs and channels_last inputs (CUDA only, eager on other devices)
+        self.compile_step = compile_step and self.device.type == 'cuda'
+        if compile_step and not self.compile_step:
+            logging.warning(f"Compiled training step not available on {self.device}, running eagerly")
+        # Augmentation applied to the training batches on the device (e.g. a BatchAugment)
+        self.augment = augment
+
+    def state_dict(self):
+        """
+        State kept between experiences: the model (with the conceptor buffers and the packed free dimensions of its
+        layers), the conceptor list, the experience counter and the Forgetting metric
+        """
+        return {'model': self.model.state_dict(),
+                'conceptor_list': self.conceptor_list,
+                'experience_id': self.experience_id,
+                'forgetting': {'initial': dict(self.forgetting_metric.initial),
+                               'last': dict(self.forgetting_metric.last)}}
+
+    def load_state_dict(self, state_dict):
+        # The layers resize their buffers and packed free dimensions (and rebuild conceptor_intersection) on load
+        self.model.load_state_dict(state_dict['model'])
+        self.conceptor_list = state_dict['conceptor_list']
+        self.experience_id = state_dict['experience_id']
+        self.forgetting_metric.initial = dict(state_dict['forgetting']['initial'])
+        self.forgetting_metric.last = dict(state_dict['forgetting']['last'])
 
     def update_basis(self, experience, exp_id):
         if hasattr(experience, "dataset"):
@@ -52,39 +95,60 @@ class MyStrategy():
             train_dataset = experience
 
         batch_size = self.basis_bs
-        train_data_loader = DataLoader(
-            train_dataset, num_workers=4, batch_size=batch_size, shuffle=True
+        train_data_loader = self.loaders.get(
+            train_dataset, batch_size=batch_size, shuffle=True
         )
 
-        mat_list = []
-        self.model.eval()
+        mat_list, correlation = self.layer_statistics(train_data_loader, exp_id)
         with torch.no_grad():
-            for batch_idx, (inputs, labels) in enumerate(train_data_loader):
-                activations = self.model.forward_all_layers(inputs.cuda(), exp_id)
-                [mat_list.append(x) for x in activations]
-                break
             self.conceptor_list = code_cl.update_basis(mat_list, conceptor_list=self.conceptor_list,
                                                        threshold=self.threshold, aperture=self.aperture,
                                                        model_name=self.model_name, memory_threshold=self.aperture_gain,
-                                                       lower_sval_bound=self.lower_bound)
+                                                       lower_sval_bound=self.lower_bound, correlation=correlation,
+                                                       device=self.conceptor_device)
         self.model.update_basis(self.conceptor_list)
+        # Last use of the experience
+        self.loaders.release(train_dataset)
+
+    def layer_statistics(self, dataloader, task_id):
+        """
+        Runs forward_all_layers on the first self.basis_batches batches of dataloader (all of them if basis_batches < 1).
+        Returns the activations of the first batch and, when more than one batch is used, the per-layer correlation
+        matrices accumulated over all of them (None otherwise). The batches are augmented as the training ones, as the
+        conceptors were computed on the train_transform samples before the augmentation moved to the device.
+        """
+        mat_list = None
+        accumulator = None
+        if self.basis_batches != 1:
+            accumulator = code_cl.CorrelationAccumulator(self.model_name, device=self.conceptor_device)
+        self.model.eval()
+        with torch.no_grad():
+            for batch_idx, batch in enumerate(dataloader):
+                inputs = batch[0].to(self.device, non_blocking=True)
+                if self.augment is not None:
+                    inputs = self.augment(inputs)
+                activations = self.model.forward_all_layers(inputs, task_id)
+                if mat_list is None:
+                    mat_list = list(activations)
+                if accumulator is None:
+                    break
+                accumulator.update(activations)
+                if batch_idx + 1 == self.basis_batches:
+                    break
+        return mat_list, None if accumulator is None else accumulator.correlation()
 
     def criterion(self, output, target):
         return self.loss_fn(output, target)
 
     def task_similarity(self, dataloader, optimizer, task_id):
-        mat_list = []
-        self.model.eval()
+        mat_list, correlation = self.layer_statistics(dataloader, task_id)
         features_list_new = []
         with torch.no_grad():
-            for batch_idx, (inputs, labels) in enumerate(dataloader):
-                activations = self.model.forward_all_layers(inputs.cuda(), task_id)
-                [mat_list.append(x) for x in activations]
-                break
             features_list_new = code_cl.update_basis(mat_list, conceptor_list=features_list_new,
                                                      threshold=self.threshold, aperture=self.aperture,
                                                      model_name=self.model_name, memory_threshold=self.aperture_gain,
-                                                     lower_sval_bound=0.2, print_logs=False)
+                                                     lower_sval_bound=0.2, print_logs=False, correlation=correlation,
+                                                     device=self.conceptor_device)
         self.model.measure_tasks_similarity(task_id, features_list_new)
 
     def train(self, experience, test_experience=None, experience_zero=None):
@@ -93,29 +157,42 @@ class MyStrategy():
         else:
             train_dataset = experience
 
-        train_data_loader = DataLoader(
-            train_dataset, num_workers=4, batch_size=self.batch_size, shuffle=True
+        train_data_loader = self.loaders.get(
+            train_dataset, batch_size=self.batch_size, shuffle=True
         )
 
-        optimizer = optim.SGD(self.model.parameters(), lr=self.lr, momentum=0, weight_decay=0)
-
         logging.info("#" * 20)
         logging.info(f"Training on task: {self.experience_id}")
         logging.info("#" * 20)
+
+        # Evaluate gradients (before building the optimizer, as it may add the scale parameters of the task)
+        if self.experience_id != 0:
+            conceptor_data_loader = self.loaders.get(
+                train_dataset, batch_size=self.basis_bs, shuffle=True
+            )
+            self.task_similarity(conceptor_data_loader, None, task_id=self.experience_id)
+            conceptor_data_loader = None
+
+        # With gradient hooks the projection runs during the backward pass instead of in the optimizer step
+        hooks = self.model.register_gradient_hooks() if self.grad_hooks and self.experience_id != 0 else []
+        optimizer = ConceptorSGD(self.model.parameters(), lr=self.lr,
+                                 conceptor_layers=[] if hooks else self.model.conceptor_layers(),
+                                 frozen=self.model.frozen_parameters(), project=self.experience_id != 0)
+        # With fp16 the loss is scaled, scaler.step unscales the fp32 gradients before ConceptorSGD projects them (the
+        # projection of the hooks is linear and commutes with the unscaling)
+        scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16 and self.device.type == 'cuda')
+        # Compiled training step, recompiled for each task as the adapters of the layers only change between tasks
+        model = self.model
+        if self.compile_step:
+            torch._dynamo.reset()
+            model = torch.compile(self.model, mode='reduce-overhead')
+
         best_model = get_model(self.model)
         best_loss = 1000
         best_acc = 0
         flag = False
         lr_updated = self.lr
 
-        # Evaluate gradients
-        if self.experience_id != 0:
-            conceptor_data_loader = DataLoader(
-                train_dataset, num_workers=4, batch_size=self.basis_bs, shuffle=True
-            )
-            self.task_similarity(conceptor_data_loader, optimizer, task_id=self.experience_id)
-            conceptor_data_loader = None
-
         for epoch in range(self.epochs):
             if self.dropout:
                 self.model.train()
@@ -134,16 +211,19 @@ class MyStrategy():
             for batch_idx, (inputs, labels) in enumerate(train_data_loader):
                 data_time.update(time.time() - end)
                 batch_size = inputs.size(0)
-                inputs = inputs.cuda()
-                labels = labels.cuda()
-                outputs = self.model(inputs, labels, self.experience_id)
-
-                loss = self.criterion(outputs, labels)
+                inputs = inputs.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True)
+                if self.augment is not None:
+                    inputs = self.augment(inputs)
+                if self.compile_step and inputs.dim() == 4:
+                    inputs = inputs.contiguous(memory_format=torch.channels_last)
+                with torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+                    outputs = model(inputs, labels, self.experience_id)
+                    loss = self.criterion(outputs, labels)
                 optimizer.zero_grad()
-                loss.backward()
-                if self.experience_id != 0:
-                    self.model.update_gradient()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 acc1, acc5 = accuracy(outputs, labels, topk=(1, 5))
                 top1.update(acc1[0], batch_size)
@@ -170,6 +250,12 @@ class MyStrategy():
                         patience = 0
                     elif lr_updated < self.lr_threshold:
                         break
+        for hook in hooks:
+            hook.remove()
+        # The training and validation loaders are not used again (the conceptor one is, by update_basis)
+        self.loaders.release(train_dataset, self.batch_size)
+        if test_experience is not None:
+            self.loaders.release(test_experience.dataset if hasattr(test_experience, "dataset") else test_experience)
         set_model_(self.model, best_model)
         self.experience_id += 1
         # self.model.update_previous_weights()
@@ -179,8 +265,8 @@ class MyStrategy():
             eval_dataset = experience.dataset
         else:
             eval_dataset = experience
-        eval_data_loader = DataLoader(
-            eval_dataset, num_workers=4, batch_size=512
+        eval_data_loader = self.loaders.get(
+            eval_dataset, batch_size=512
         )
         top1 = AverageMeter('Acc@1', ':6.2f')
         top5 = AverageMeter('Acc@5', ':6.2f')
@@ -188,8 +274,8 @@ class MyStrategy():
         with torch.no_grad():
             self.model.eval()
             for batch_idx, (inputs, labels) in enumerate(eval_data_loader):
-                inputs = inputs.cuda()
-                labels = labels.cuda()
+                inputs = inputs.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True)
                 batch_size = inputs.size(0)
                 outputs = self.model(inputs, experience_id=self.experience_id if test_id is None else test_id)
                 loss = self.criterion(outputs, labels)
@@ -205,16 +291,16 @@ class MyStrategy():
             eval_dataset = experience.dataset
         else:
             eval_dataset = experience
-        eval_data_loader = DataLoader(
-            eval_dataset, num_workers=4, batch_size=512
+        eval_data_loader = self.loaders.get(
+            eval_dataset, batch_size=512
         )
         top1 = AverageMeter('Acc@1', ':6.2f')
         top5 = AverageMeter('Acc@5', ':6.2f')
         with torch.no_grad():
             self.model.eval()
             for batch_idx, (inputs, labels) in enumerate(eval_data_loader):
-                inputs = inputs.cuda()
-                labels = labels.cuda()
+                inputs = inputs.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True)
                 batch_size = inputs.size(0)
                 outputs = self.model(inputs, experience_id=exp_test_id)
                 # loss = criterion(outputs, labels)
@@ -227,6 +313,50 @@ class MyStrategy():
         mlflow.log_metric(f"acc_exp_{exp_test_id}", top1.avg.item(), step=exp_id)
         return top1.avg.item()
 
+    def eval_all(self, experiences, exp_id, test_ids=None):
+        """
+        Evaluates several experiences (by default with the task ids 0, 1, ...) with one DataLoader. The batches are the
+        ones eval uses for each experience, the correct predictions are counted on the device and the Forgetting metric
+        and mlflow are updated once at the end. Returns the list of top-1 accuracies
+        """
+        if test_ids is None:
+            test_ids = list(range(len(experiences)))
+        datasets = [experience.dataset if hasattr(experience, "dataset") else experience for experience in experiences]
+        if all(isinstance(dataset, DeviceTensorDataset) for dataset in datasets):
+            # Device-resident experiences are sliced directly
+            batch_tasks = [test_id for test_id, dataset in zip(test_ids, datasets)
+                           for _ in range(len(DeviceDataLoader(dataset, batch_size=512)))]
+            eval_data_loader = (batch for dataset in datasets for batch in DeviceDataLoader(dataset, batch_size=512))
+        else:
+            batches, batch_tasks, offset = [], [], 0
+            for test_id, dataset in zip(test_ids, datasets):
+                for start in range(0, len(dataset), 512):
+                    batches.append(list(range(offset + start, offset + min(start + 512, len(dataset)))))
+                    batch_tasks.append(test_id)
+                offset += len(dataset)
+            eval_data_loader = self.loaders.prefetch(DataLoader(ConcatDataset(datasets), num_workers=4,
+                                                                batch_sampler=batches,
+                                                                pin_memory=self.device.type == 'cuda'))
+        correct = {test_id: torch.zeros(2, device=self.device) for test_id in test_ids}
+        with torch.no_grad():
+            self.model.eval()
+            for test_id, batch in zip(batch_tasks, eval_data_loader):
+                inputs = batch[0].to(self.device, non_blocking=True)
+                labels = batch[1].to(self.device, non_blocking=True)
+                outputs = self.model(inputs, experience_id=test_id)
+                pred = outputs.topk(5, 1, True, True)[1].eq(labels.view(-1, 1))
+                correct[test_id] += torch.stack([pred[:, :1].sum(), pred.sum()])
+        accuracies = []
+        for test_id, dataset in zip(test_ids, datasets):
+            acc1, acc5 = (100.0 * correct[test_id] / len(dataset)).tolist()
+            logging.info(f'Testing experience: {test_id}')
+            logging.info(' @Testing * Acc@1 {:.3f} Acc@5 {:.3f}'.format(acc1, acc5))
+            self.forgetting_metric.update(k=f"Experience {test_id}", v=acc1,
+                                          initial=test_id == (self.experience_id - 1))
+            accuracies.append(acc1)
+        mlflow.log_metrics({f"acc_exp_{test_id}": acc for test_id, acc in zip(test_ids, accuracies)}, step=exp_id)
+        return accuracies
+
 
 def average_forgetting_metric(forgetting_dict):
     avg_forgetting = 0
@@ -251,4 +381,4 @@ def set_model_(model, state_dict):
 
 def adjust_learning_rate(optimizer, epoch, args):
     for param_group in optimizer.param_groups:
-        param_group['lr']=param_group['lr']/2
\ No newline at end of file
+        param_group['lr']=param_group['lr']/2
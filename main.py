@@ -2,7 +2,6 @@ import torch
 from torch import nn
 import torch.optim as optim
 from avalanche.benchmarks.classic import PermutedMNIST, SplitCIFAR100
-from avalanche.benchmarks.datasets import MiniImageNetDataset
 from avalanche.benchmarks import class_incremental_benchmark, nc_benchmark
 from torch.utils.data import DataLoader
 from utils.metrics import *
@@ -15,81 +14,57 @@ from copy import deepcopy
 from models.nn_models import AlexNet, BaseModel, MLP, ResNet18
 from torchvision import transforms
 from cl_method import code_cl, strategy
-from utils import parse_args
+from cl_method.conceptor_sgd import ConceptorSGD
+from utils import parse_args, BatchAugment, MiniImageNetShards
+from utils import CheckpointWriter, experience_state, load_checkpoint, resume_point, set_rng_state, log_run_params
 import os
 warnings.filterwarnings("ignore", category=UserWarning)
 
 
 class MyStrategy(strategy.MyStrategy):
 
-    def update_basis(self, experience, exp_id):
-        if hasattr(experience, "dataset"):
-            train_dataset = experience.dataset
-        else:
-            train_dataset = experience
-
-        batch_size = self.basis_bs
-        train_data_loader = DataLoader(
-            train_dataset, num_workers=4, batch_size=batch_size, shuffle=True
-        )
-
-        mat_list = []
-        self.model.eval()
-        with torch.no_grad():
-            for batch_idx, (inputs, labels, _) in enumerate(train_data_loader):
-                activations = self.model.forward_all_layers(inputs.cuda(), exp_id)
-                [mat_list.append(x) for x in activations]
-                break
-            self.conceptor_list = code_cl.update_basis(mat_list, conceptor_list=self.conceptor_list,
-                                                       threshold=self.threshold, aperture=self.aperture,
-                                                       model_name=self.model_name, memory_threshold=self.aperture_gain,
-                                                       lower_sval_bound=0.2)
-        self.model.update_basis(self.conceptor_list)
-
-    def task_similarity(self, dataloader, optimizer, task_id):
-        mat_list = []
-        self.model.eval()
-        features_list_new = []
-        with torch.no_grad():
-            for batch_idx, (inputs, labels, _) in enumerate(dataloader):
-                activations = self.model.forward_all_layers(inputs.cuda(), task_id)
-                [mat_list.append(x) for x in activations]
-                break
-            features_list_new = code_cl.update_basis(mat_list, conceptor_list=features_list_new,
-                                                     threshold=self.threshold, aperture=self.aperture,
-                                                     model_name=self.model_name, memory_threshold=self.aperture_gain,
-                                                     lower_sval_bound=0.2, print_logs=False)
-        self.model.measure_tasks_similarity(task_id, features_list_new)
-
     def train(self, experience, test_experience=None, experience_zero=None):
         if hasattr(experience, "dataset"):
             train_dataset = experience.dataset
         else:
             train_dataset = experience
 
-        train_data_loader = DataLoader(
-            train_dataset, num_workers=4, batch_size=self.batch_size, shuffle=True
+        train_data_loader = self.loaders.get(
+            train_dataset, batch_size=self.batch_size, shuffle=True
         )
 
-        optimizer = optim.SGD(self.model.parameters(), lr=self.lr, momentum=0, weight_decay=0)
-
         logging.info("#" * 20)
         logging.info(f"Training on task: {self.experience_id}")
         logging.info("#" * 20)
+
+        # Evaluate gradients (before building the optimizer, as it may add the scale parameters of the task)
+        if self.experience_id != 0:
+            conceptor_data_loader = self.loaders.get(
+                train_dataset, batch_size=self.basis_bs, shuffle=True
+            )
+            self.task_similarity(conceptor_data_loader, None, task_id=self.experience_id)
+            conceptor_data_loader = None
+
+        # With gradient hooks the projection runs during the backward pass instead of in the optimizer step
+        hooks = self.model.register_gradient_hooks() if self.grad_hooks and self.experience_id != 0 else []
+        optimizer = ConceptorSGD(self.model.parameters(), lr=self.lr,
+                                 conceptor_layers=[] if hooks else self.model.conceptor_layers(),
+                                 frozen=self.model.frozen_parameters(), project=self.experience_id != 0)
+        # With fp16 the loss is scaled, scaler.step unscales the fp32 gradients before ConceptorSGD projects them (the
+        # projection of the hooks is linear and commutes with the unscaling)
+        scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16 and self.device.type == 'cuda')
+        # Compiled training step, recompiled for each task as the adapters of the layers only change between tasks
+        model = self.model
+        if self.compile_step:
+            torch._dynamo.reset()
+            model = torch.compile(self.model, mode='reduce-overhead')
+
         best_model = get_model(self.model)
         best_loss = 1000
         best_acc = 0
         flag = False
         lr_updated = self.lr
 
-        # Evaluate gradients
-        if self.experience_id != 0:
-            conceptor_data_loader = DataLoader(
-                train_dataset, num_workers=4, batch_size=self.basis_bs, shuffle=True
-            )
-            self.task_similarity(conceptor_data_loader, optimizer, task_id=self.experience_id)
-            conceptor_data_loader = None
-
         for epoch in range(self.epochs):
             if self.dropout:
                 self.model.train()
@@ -105,18 +80,22 @@ class MyStrategy(strategy.MyStrategy):
                 [batch_time, data_time, losses, top1, top5],
                 prefix="Epoch: [{}]".format(epoch))
             end = time.time()
-            for batch_idx, (inputs, labels, _) in enumerate(train_data_loader):
+            for batch_idx, (inputs, labels, *_) in enumerate(train_data_loader):
                 data_time.update(time.time() - end)
                 batch_size = inputs.size(0)
-                inputs = inputs.cuda()
-                labels = labels.cuda()
-                outputs = self.model(inputs, labels, self.experience_id)
-                loss = self.criterion(outputs, labels)
+                inputs = inputs.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True)
+                if self.augment is not None:
+                    inputs = self.augment(inputs)
+                if self.compile_step and inputs.dim() == 4:
+                    inputs = inputs.contiguous(memory_format=torch.channels_last)
+                with torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+                    outputs = model(inputs, labels, self.experience_id)
+                    loss = self.criterion(outputs, labels)
                 optimizer.zero_grad()
-                loss.backward()
-                if self.experience_id != 0:
-                    self.model.update_gradient()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 acc1, acc5 = accuracy(outputs, labels, topk=(1, 5))
                 top1.update(acc1[0], batch_size)
@@ -143,6 +122,12 @@ class MyStrategy(strategy.MyStrategy):
                         patience = 0
                     elif lr_updated < self.lr_threshold:
                         break
+        for hook in hooks:
+            hook.remove()
+        # The training and validation loaders are not used again (the conceptor one is, by update_basis)
+        self.loaders.release(train_dataset, self.batch_size)
+        if test_experience is not None:
+            self.loaders.release(test_experience.dataset if hasattr(test_experience, "dataset") else test_experience)
         set_model_(self.model, best_model)
         self.experience_id += 1
         # self.model.update_previous_weights()
@@ -152,17 +137,17 @@ class MyStrategy(strategy.MyStrategy):
             eval_dataset = experience.dataset
         else:
             eval_dataset = experience
-        eval_data_loader = DataLoader(
-            eval_dataset, num_workers=4, batch_size=512
+        eval_data_loader = self.loaders.get(
+            eval_dataset, batch_size=512
         )
         top1 = AverageMeter('Acc@1', ':6.2f')
         top5 = AverageMeter('Acc@5', ':6.2f')
         losses = AverageMeter('Loss', ':.4e')
         with torch.no_grad():
             self.model.eval()
-            for batch_idx, (inputs, labels, _) in enumerate(eval_data_loader):
-                inputs = inputs.cuda()
-                labels = labels.cuda()
+            for batch_idx, (inputs, labels, *_) in enumerate(eval_data_loader):
+                inputs = inputs.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True)
                 batch_size = inputs.size(0)
                 outputs = self.model(inputs, experience_id=self.experience_id if test_id is None else test_id)
                 loss = self.criterion(outputs, labels)
@@ -180,16 +165,16 @@ class MyStrategy(strategy.MyStrategy):
             eval_dataset = experience.dataset
         else:
             eval_dataset = experience
-        eval_data_loader = DataLoader(
-            eval_dataset, num_workers=4, batch_size=512
+        eval_data_loader = self.loaders.get(
+            eval_dataset, batch_size=512
         )
         top1 = AverageMeter('Acc@1', ':6.2f')
         top5 = AverageMeter('Acc@5', ':6.2f')
         with torch.no_grad():
             self.model.eval()
-            for batch_idx, (inputs, labels, _) in enumerate(eval_data_loader):
-                inputs = inputs.cuda()
-                labels = labels.cuda()
+            for batch_idx, (inputs, labels, *_) in enumerate(eval_data_loader):
+                inputs = inputs.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True)
                 batch_size = inputs.size(0)
                 outputs = self.model(inputs, experience_id=exp_test_id)
                 # loss = criterion(outputs, labels)
@@ -233,8 +218,14 @@ def adjust_learning_rate(optimizer, epoch, args):
 if __name__ == '__main__':
     args = parse_args()
 
-    folder_name = f"{args.experiment_name}_{torch.randint(low=0, high=100000, size=[1]).item()}"
-    args.save_path = args.save_path + "/" + folder_name
+    # A resumed run continues in its folder, from its last checkpoint
+    checkpoint_resume = None
+    if args.resume is not None:
+        args.save_path = args.resume
+        checkpoint_resume = load_checkpoint(args.save_path + "/checkpoint.pt")
+    else:
+        folder_name = f"{args.experiment_name}_{torch.randint(low=0, high=100000, size=[1]).item()}"
+        args.save_path = args.save_path + "/" + folder_name
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
 
@@ -251,7 +242,7 @@ if __name__ == '__main__':
 
     experiment_name = args.experiment_name
     mlflow.set_experiment(experiment_name)
-    with mlflow.start_run():
+    with mlflow.start_run(run_id=None if checkpoint_resume is None else checkpoint_resume['run_id']):
         n_experiences = args.n_experiences
         epochs = args.epochs
         lr = args.lr
@@ -268,8 +259,7 @@ if __name__ == '__main__':
         print_freq = args.print_freq
         aperture_gain = args.aperture_gain
 
-        for key in args.__dict__.keys():
-            mlflow.log_param(key, args.__dict__[key])
+        log_run_params(args.__dict__)
 
         # if dataset == "PermutedMNIST":
         #     transform_train = transforms.Compose([
@@ -288,25 +278,20 @@ if __name__ == '__main__':
         if dataset == "MiniIMAGENET":
             mean = [x / 255 for x in [125.3, 123.0, 113.9]]
             std = [x / 255 for x in [63.0, 62.1, 66.7]]
-            if data_aug:
-                transform_train = transforms.Compose([
-                    transforms.RandomCrop(84, padding=8),
-                    transforms.RandomHorizontalFlip(),
-                    transforms.ToTensor(),
-                    transforms.Normalize(mean, std),
-                    transforms.RandomErasing(p=0.2)
-                ])
-            else:
-                transform_train = transforms.Compose([
-                    transforms.ToTensor(),
-                    transforms.Normalize(mean, std),
-                ])
+            # The augmentation (RandomCrop(84, padding=8), RandomHorizontalFlip and RandomErasing(p=0.2)) is applied
+            # to the normalized batches on the device, the padding is the normalized value of a black pixel
+            augment = BatchAugment(padding=8, fill=[-m / s for m, s in zip(mean, std)],
+                                   erasing=0.2) if data_aug else None
+            transform_train = transforms.Compose([
+                transforms.ToTensor(),
+                transforms.Normalize(mean, std),
+            ])
             transform_test = transforms.Compose([
                 transforms.ToTensor(),
                 transforms.Normalize(mean, std),
             ])
 
-            imagenet_dataset = MiniImageNetDataset("/local/a/imagenet/imagenet2012/")
+            imagenet_dataset = MiniImageNetShards("/local/a/imagenet/imagenet2012/")
             generator = torch.Generator().manual_seed(42)
             logging.info(len(imagenet_dataset))
             train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(
@@ -344,11 +329,11 @@ if __name__ == '__main__':
             raise NotImplementedError(f"{dataset} is not available")
 
         if model == "MLP":
-            model_ = MLP(threshold_linear=threshold_linear, num_free_dim=args.num_free_dim).cuda()
+            model_ = MLP(threshold_linear=threshold_linear, num_free_dim=args.num_free_dim).to(args.device)
         elif model == "ResNet18":
             model_ = ResNet18(n_experiences=n_experiences, n_classes=int(100//n_experiences),
                               threshold_conv=threshold_conv, threshold_linear=threshold_linear,
-                              num_free_dim=args.num_free_dim).cuda()
+                              num_free_dim=args.num_free_dim).to(args.device)
         else:
             raise NotImplementedError(f"{model} is not available")
 
@@ -356,29 +341,53 @@ if __name__ == '__main__':
                                  threshold=[0, 0], aperture=aperture,
                                  dropout=dropout, data_aug=data_aug, basis_bs=basis_bs, avg_pool=avg_pool,
                                  transform_test=transform_test, transform_train=transform_train, dataset_name=dataset,
-                                 model_name=model, print_freq=print_freq, aperture_gain=aperture_gain)
+                                 model_name=model, print_freq=print_freq, aperture_gain=aperture_gain,
+                                 basis_batches=args.basis_batches, device=args.device,
+                                 conceptor_device=args.conceptor_device, grad_hooks=args.grad_hooks,
+                                 weight_cache_mb=args.weight_cache_mb, amp=args.amp,
+                                 compile_step=args.compile_step, augment=augment)
 
         accuracy_history = []
         accuracy_list = []
+        # Checkpoint written after the evaluation and after the basis update of each experience
+        checkpoint = CheckpointWriter(args.save_path + "/checkpoint.pt", async_write=args.async_checkpoint)
+        first_exp, evaluated = 0, False
+        if checkpoint_resume is not None:
+            cl_strategy.load_state_dict(checkpoint_resume['strategy'])
+            accuracy_history = checkpoint_resume['accuracy_history']
+            set_rng_state(checkpoint_resume['rng'])
+            first_exp, evaluated = resume_point(checkpoint_resume)
+            logging.info(f"Resuming from experience {first_exp}")
+        # The experiences of the benchmarks are read from the shards as uint8 batches, normalized on the device (kept
+        # on the device with --device-data, test sets kept for the evaluations)
+        data_device = args.device if args.device_data else 'cpu'
+        experiences_eval = {}
         logging.info('Starting experiment...')
         for exp_id, experience in enumerate(benchmark.train_stream):
-            logging.info("Start of experience: {0}".format( experience.current_experience))
-            cl_strategy.train(experience, benchmark_val.test_stream[exp_id], experience_zero=benchmark.test_stream[0])
-            logging.info('Training completed')
-
-            for exp_test_id in range(n_experiences):
-                logging.info(f'Testing experience: {exp_test_id}')
-                if exp_test_id <= exp_id:
-                    acc = cl_strategy.eval(benchmark.test_stream[exp_test_id], exp_id, exp_test_id)
-                    accuracy_list.append(acc)
+            if exp_id < first_exp:
+                continue
+            experience_train = imagenet_dataset.experience(benchmark, train_dataset, 'train', exp_id, data_device)
+            if not (exp_id == first_exp and evaluated):
+                logging.info("Start of experience: {0}".format( experience.current_experience))
+                experience_valid = imagenet_dataset.experience(benchmark_val, val_dataset, 'test', exp_id, data_device)
+                for exp_test_id in range(exp_id + 1):
+                    if exp_test_id not in experiences_eval:
+                        experiences_eval[exp_test_id] = imagenet_dataset.experience(benchmark, test_dataset, 'test',
+                                                                                    exp_test_id, data_device)
+                cl_strategy.train(experience_train, experience_valid, experience_zero=experiences_eval[0])
+                logging.info('Training completed')
+
+                accuracy_list = cl_strategy.eval_all([experiences_eval[exp_test_id]
+                                                      for exp_test_id in range(exp_id + 1)], exp_id)
+                accuracy_history.append(accuracy_list)
+                accuracy_list = []
+                checkpoint.save(experience_state(cl_strategy, exp_id, 'evaluated', accuracy_history))
             logging.info(cl_strategy.forgetting_metric.result())
             fogetting_dict = cl_strategy.forgetting_metric.result()
-            for key in fogetting_dict.keys():
-                mlflow.log_metric("Forgetting_"+key, fogetting_dict[key], step=exp_id)
+            mlflow.log_metrics({"Forgetting_" + key: value for key, value in fogetting_dict.items()}, step=exp_id)
             if exp_id + 1 < len(benchmark.train_stream):
-                cl_strategy.update_basis(benchmark.train_stream[exp_id], exp_id)
-            accuracy_history.append(accuracy_list)
-            accuracy_list = []
+                cl_strategy.update_basis(experience_train, exp_id)
+                checkpoint.save(experience_state(cl_strategy, exp_id, 'basis', accuracy_history))
             avg_forgetting = average_forgetting_metric(fogetting_dict)
             logging.info(f"Average Forgetting: {avg_forgetting}")
             logging.info(f"Average Accuracy: {np.mean(np.array(accuracy_history[-1]))}")
@@ -387,4 +396,5 @@ if __name__ == '__main__':
 
         avg_forgetting = average_forgetting_metric(fogetting_dict)
         mlflow.log_metric("avg_forgetting", avg_forgetting)
-        mlflow.log_metric("avg_accuracy", np.mean(np.array(accuracy_history[-1])))
\ No newline at end of file
+        mlflow.log_metric("avg_accuracy", np.mean(np.array(accuracy_history[-1])))
+        checkpoint.wait()
\ No newline at end of file
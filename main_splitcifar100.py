@@ -5,18 +5,23 @@ import mlflow
 import logging
 import warnings
 from models.nn_models import AlexNet
-from torch.utils.data.dataset import TensorDataset
-from avalanche.benchmarks.utils import AvalancheDataset
 from cl_method import code_cl, strategy
-from utils import parse_args
+from utils import parse_args, tensor_experience, BatchAugment
+from utils import CheckpointWriter, experience_state, load_checkpoint, resume_point, set_rng_state, log_run_params
 import os
 warnings.filterwarnings("ignore", category=UserWarning)
 
 if __name__ == '__main__':
     args = parse_args()
 
-    folder_name = f"{args.experiment_name}_{torch.randint(low=0, high=100000, size=[1]).item()}"
-    args.save_path = args.save_path + "/" + folder_name
+    # A resumed run continues in its folder, from its last checkpoint
+    checkpoint_resume = None
+    if args.resume is not None:
+        args.save_path = args.resume
+        checkpoint_resume = load_checkpoint(args.save_path + "/checkpoint.pt")
+    else:
+        folder_name = f"{args.experiment_name}_{torch.randint(low=0, high=100000, size=[1]).item()}"
+        args.save_path = args.save_path + "/" + folder_name
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
 
@@ -33,7 +38,7 @@ if __name__ == '__main__':
 
     experiment_name = args.experiment_name
     mlflow.set_experiment(experiment_name)
-    with mlflow.start_run():
+    with mlflow.start_run(run_id=None if checkpoint_resume is None else checkpoint_resume['run_id']):
         n_experiences = args.n_experiences
         epochs = args.epochs
         lr = args.lr
@@ -50,8 +55,7 @@ if __name__ == '__main__':
         print_freq = args.print_freq
         aperture_gain = args.aperture_gain
 
-        for key in args.__dict__.keys():
-            mlflow.log_param(key, args.__dict__[key])
+        log_run_params(args.__dict__)
 
 
         from utils import cifar100 as cf100
@@ -60,7 +64,7 @@ if __name__ == '__main__':
         if model == "AlexNet":
             model_ = AlexNet(n_experiences=n_experiences, n_classes=int(100//n_experiences),
                              threshold_conv=threshold_conv, threshold_linear=threshold_linear,
-                             num_free_dim=args.num_free_dim).cuda()
+                             num_free_dim=args.num_free_dim).to(args.device)
         else:
             raise NotImplementedError(f"{model} is not available")
 
@@ -70,18 +74,35 @@ if __name__ == '__main__':
                                           basis_bs=basis_bs, avg_pool=avg_pool, transform_test=None,
                                           transform_train=None, dataset_name=dataset, model_name=model,
                                           print_freq=print_freq, aperture_gain=aperture_gain, patience=args.patience,
-                                          lr_decay=args.lr_decay, lr_threshold=args.lr_threshold)
+                                          lr_decay=args.lr_decay, lr_threshold=args.lr_threshold,
+                                          basis_batches=args.basis_batches, device=args.device,
+                                          conceptor_device=args.conceptor_device, grad_hooks=args.grad_hooks,
+                                          weight_cache_mb=args.weight_cache_mb, amp=args.amp,
+                                          compile_step=args.compile_step,
+                                          augment=BatchAugment(padding=4, erasing=0.2) if data_aug else None)
 
         # Training Loop
         accuracy_history = []
         accuracy_list = []
+        # Checkpoint written after the evaluation and after the basis update of each experience
+        checkpoint = CheckpointWriter(args.save_path + "/checkpoint.pt", async_write=args.async_checkpoint)
+        first_exp, evaluated = 0, False
+        if checkpoint_resume is not None:
+            cl_strategy.load_state_dict(checkpoint_resume['strategy'])
+            accuracy_history = checkpoint_resume['accuracy_history']
+            set_rng_state(checkpoint_resume['rng'])
+            first_exp, evaluated = resume_point(checkpoint_resume)
+            logging.info(f"Resuming from experience {first_exp}")
         logging.info('Starting experiment...')
 
         xtest = data[0]['test']['x']
         ytest = data[0]['test']['y']
 
-        torch_data_test = TensorDataset(xtest, ytest)
-        experience_test_zero = AvalancheDataset(torch_data_test)
+        # The tasks are kept as uint8 tensors and normalized batch by batch, on the host or, with --device-data, moved
+        # once to the device (test sets kept for the evaluations)
+        data_device = args.device if args.device_data else 'cpu'
+        experiences_eval = {}
+        experience_test_zero = tensor_experience(xtest, ytest, device=data_device, transform=cf100.normalize)
 
         task_id = 0
         task_list = []
@@ -98,34 +119,35 @@ if __name__ == '__main__':
             xtest = data[k]['test']['x']
             ytest = data[k]['test']['y']
             task_list.append(k)
-
-            torch_data_train = TensorDataset(xtrain, ytrain)
-            experience_train = AvalancheDataset(torch_data_train)
-
-            torch_data_test = TensorDataset(xvalid, yvalid)
-            experience_test = AvalancheDataset(torch_data_test)
-
-            logging.info("Start of experience {0}".format(task_id))
-            # cl_strategy.similarity_analysis(benchmark.train_stream[exp_id])
-            cl_strategy.train(experience_train, experience_test, experience_zero=experience_test_zero)
-
-            for exp_test_id in task_list:
-                xeval = data[exp_test_id]['test']['x']
-                yeval = data[exp_test_id]['test']['y']
-                torch_data_eval = TensorDataset(xeval, yeval)
-                experience_eval = AvalancheDataset(torch_data_eval)
-                logging.info('Testing experience: {0}'.format(exp_test_id))
-                if exp_test_id <= task_id:
-                    acc = cl_strategy.eval(experience_eval, task_id, exp_test_id)
-                    accuracy_list.append(acc)
+            if task_id < first_exp:
+                task_id += 1
+                continue
+
+            experience_train = tensor_experience(xtrain, ytrain, device=data_device, transform=cf100.normalize)
+            experience_test = tensor_experience(xvalid, yvalid, device=data_device, transform=cf100.normalize)
+
+            if not (task_id == first_exp and evaluated):
+                logging.info("Start of experience {0}".format(task_id))
+                # cl_strategy.similarity_analysis(benchmark.train_stream[exp_id])
+                cl_strategy.train(experience_train, experience_test, experience_zero=experience_test_zero)
+
+                test_ids = [exp_test_id for exp_test_id in task_list if exp_test_id <= task_id]
+                for exp_test_id in test_ids:
+                    if exp_test_id not in experiences_eval:
+                        experiences_eval[exp_test_id] = tensor_experience(data[exp_test_id]['test']['x'],
+                                                                          data[exp_test_id]['test']['y'],
+                                                                          device=data_device, transform=cf100.normalize)
+                accuracy_list = cl_strategy.eval_all([experiences_eval[exp_test_id] for exp_test_id in test_ids],
+                                                     task_id, test_ids)
+                accuracy_history.append(accuracy_list)
+                accuracy_list = []
+                checkpoint.save(experience_state(cl_strategy, task_id, 'evaluated', accuracy_history))
             logging.info(cl_strategy.forgetting_metric.result())
             fogetting_dict = cl_strategy.forgetting_metric.result()
-            for key in fogetting_dict.keys():
-                mlflow.log_metric("Forgetting_" + key, fogetting_dict[key], step=task_id)
+            mlflow.log_metrics({"Forgetting_" + key: value for key, value in fogetting_dict.items()}, step=task_id)
             if task_id + 1 < n_experiences:
                 cl_strategy.update_basis(experience_train, task_id)
-            accuracy_history.append(accuracy_list)
-            accuracy_list = []
+                checkpoint.save(experience_state(cl_strategy, task_id, 'basis', accuracy_history))
             avg_forgetting = strategy.average_forgetting_metric(fogetting_dict)
             logging.info(f"Average Forgetting: {avg_forgetting}")
             logging.info(f"Average Accuracy: {np.mean(np.array(accuracy_history[-1]))}")
@@ -138,3 +160,4 @@ if __name__ == '__main__':
         avg_forgetting = strategy.average_forgetting_metric(fogetting_dict)
         mlflow.log_metric("avg_forgetting", avg_forgetting)
         mlflow.log_metric("avg_accuracy", np.mean(np.array(accuracy_history[-1])))
+        checkpoint.wait()
@@ -0,0 +1,302 @@
+import math
+import torch
+import copy
+import logging
+
+__all__ = ["EigenConceptor", "FactoredConceptor", "aperture_search"]
+
+# Same numerical constants used by the dense operations in conceptor_operations.py
+SVAL_MIN = 1e-8
+SVAL_MAX = 0.9999999
+RANK_TOL = 1e-6
+
+
+class EigenConceptor(object):
+    """
+    Conceptor C = U diag(s) U^T kept in eigen form. The eigendecomposition is computed once (torch.linalg.eigh) and
+    every Boolean/aperture operation is then a spectral map on s, or a projection onto the shared basis U, instead of
+    re-deriving the spectrum with SVDs and inverses as the dense operations do. U and s may carry a leading batch
+    dimension (a stack of conceptors of the same size, see stack), in which case every operation is batched.
+    :param U: (..., d, d) orthonormal eigenvectors (columns)
+    :param s: (..., d) eigenvalues in [0, 1]
+    """
+
+    def __init__(self, U, s):
+        self.U = U
+        self.s = s
+
+    @classmethod
+    def from_matrix(cls, conceptor):
+        s, U = torch.linalg.eigh(0.5 * (conceptor + conceptor.mT))
+        return cls(U, s)
+
+    @classmethod
+    def from_correlation(cls, R, aperture=4):
+        lam, U = torch.linalg.eigh(R)
+        lam = torch.clamp(lam, min=0)
+        return cls(U, lam / (lam + aperture ** -2))
+
+    @classmethod
+    def from_data(cls, data, aperture=4):
+        """
+        Equivalent to compute_conceptor(data, aperture): C = R (R + aperture^-2 I)^-1 with R = X X^T / N
+        :param data: (d, N) matrix with one sample per column
+        :param aperture:
+        :return:
+        """
+        return cls.from_correlation(torch.matmul(data, data.T) / data.size(1), aperture=aperture)
+
+    @classmethod
+    def stack(cls, conceptors):
+        return cls(torch.stack([c.U for c in conceptors]), torch.stack([c.s for c in conceptors]))
+
+    def __getitem__(self, idx):
+        return EigenConceptor(self.U[idx], self.s[idx])
+
+    @property
+    def dim(self):
+        return self.s.size(-1)
+
+    @property
+    def device(self):
+        return self.s.device
+
+    def to(self, device):
+        return EigenConceptor(self.U.to(device), self.s.to(device))
+
+    def matrix(self):
+        return torch.matmul(self.U * self.s.unsqueeze(-2), self.U.mT)
+
+    def project(self, x):
+        """
+        Computes C x without forming C.
+        """
+        return torch.matmul(self.U, self.s.unsqueeze(-1) * torch.matmul(self.U.mT, x))
+
+    def not_operation(self):
+        return EigenConceptor(self.U, 1 - self.s)
+
+    def aperture_adaptation(self, gamma):
+        s = self.s / (self.s + (gamma ** -2) * (1 - self.s))
+        return EigenConceptor(self.U, torch.clamp(s, min=SVAL_MIN, max=SVAL_MAX))
+
+    def lower_bound(self, lower_sval_bound):
+        """
+        Zeroes the eigenvalues below lower_sval_bound (the singular value thresholding done in code_cl.update_basis)
+        """
+        return EigenConceptor(self.U, torch.where(self.s < lower_sval_bound, torch.zeros_like(self.s), self.s))
+
+    def and_operation(self, other, tol=RANK_TOL):
+        """
+        C AND B = (C^+ + B^+ - I)^-1 restricted to the intersection W of the ranges of C and B, and SVAL_MIN on its
+        complement. The pseudo-inverses are read off the stored spectra; W is only computed (one eigh) when C or B has a
+        null space. The system on W is solved with a single eigh of fixed size: the basis is ordered with W first and
+        the complement block is replaced by -I, which keeps it decoupled and lets stacked conceptors whose ranges differ
+        share one batched call.
+        """
+        range_c = self.s.abs() > tol
+        range_b = other.s.abs() > tol
+        inv_c = torch.where(range_c, 1 / torch.where(range_c, self.s, torch.ones_like(self.s)), torch.zeros_like(self.s))
+        inv_b = torch.where(range_b, 1 / torch.where(range_b, other.s, torch.ones_like(other.s)), torch.zeros_like(other.s))
+        eye = torch.eye(self.dim, device=self.device, dtype=self.s.dtype)
+
+        if bool(range_c.all()) and bool(range_b.all()):
+            V, keep = None, None
+            Ac, Ab = self.U, other.U
+        else:
+            null_c = (~range_c).to(self.s.dtype).unsqueeze(-2)
+            null_b = (~range_b).to(other.s.dtype).unsqueeze(-2)
+            sigma, V = torch.linalg.eigh(torch.matmul(self.U * null_c, self.U.mT) +
+                                         torch.matmul(other.U * null_b, other.U.mT))
+            keep = sigma <= tol
+            order = torch.argsort((~keep).to(torch.int8), dim=-1, stable=True)
+            keep = torch.gather(keep, -1, order)
+            V = torch.gather(V, -1, order.unsqueeze(-2).expand_as(V))
+            Ac, Ab = torch.matmul(V.mT, self.U), torch.matmul(V.mT, other.U)
+        M = torch.matmul(Ac * inv_c.unsqueeze(-2), Ac.mT) + torch.matmul(Ab * inv_b.unsqueeze(-2), Ab.mT) - eye
+        if keep is not None:
+            block = keep.unsqueeze(-1) & keep.unsqueeze(-2)
+            M = torch.where(block, M, torch.zeros_like(M)) - torch.diag_embed((~keep).to(M.dtype))
+        m, Q = torch.linalg.eigh(0.5 * (M + M.mT))
+        # M >= I on W, the complement block has eigenvalue -1
+        s = torch.where(m > 0, torch.clamp((1 / m).abs(), min=SVAL_MIN, max=SVAL_MAX), torch.full_like(m, SVAL_MIN))
+        return EigenConceptor(Q if V is None else torch.matmul(V, Q), s)
+
+    def or_operation(self, other):
+        # NOT is free in eigen form, so OR costs a single AND
+        return self.not_operation().and_operation(other.not_operation()).not_operation()
+
+    def capacity(self):
+        return self.s.abs().mean(dim=-1)
+
+    def principal_directions(self, k):
+        """
+        Eigenvectors of the k largest eigenvalues (the leading singular vectors of the dense conceptor)
+        """
+        idx = torch.argsort(self.s.abs(), descending=True)[:k]
+        return self.U[:, idx]
+
+    def to_correlation(self, aperture=4):
+        free = (1 - self.s).abs() > RANK_TOL
+        inv = torch.where(free, 1 / torch.where(free, 1 - self.s, torch.ones_like(self.s)), torch.zeros_like(self.s))
+        return EigenConceptor(self.U, (aperture ** -2) * inv * self.s)
+
+    def similarity(self, other):
+        s1 = self.s.clamp(min=0) ** 0.5
+        s2 = other.s.clamp(min=0) ** 0.5
+        num = torch.norm(s1.unsqueeze(1) * torch.matmul(self.U.T, other.U) * s2.unsqueeze(0))
+        den = torch.norm(self.s) * torch.norm(other.s)
+        return (num ** 2) / den
+
+
+class FactoredConceptor(object):
+    """
+    Conceptor used to project the gradients of a layer: only the eigenpairs with s > tol are kept, C = U diag(s) U^T
+    with U of size (d, rank). project(grad) = G - G C is applied in factored form, (G U) diag(s) U^T, when the rank is
+    below half the dimension (2 * out * d * rank flops instead of out * d^2) and with the dense matrix otherwise.
+    :param U: (d, rank) eigenvectors
+    :param s: (rank,) eigenvalues
+    :param dim: d
+    """
+
+    def __init__(self, U, s, dim):
+        self.dim = dim
+        self.rank = s.size(0)
+        self.dense = 2 * self.rank >= dim
+        if self.dense:
+            self.C = torch.matmul(U * s, U.T)
+            self.U, self.s = None, None
+        else:
+            self.C = None
+            self.U, self.s = U, s
+
+    @classmethod
+    def from_eigen(cls, conceptor, tol=RANK_TOL):
+        keep = conceptor.s.abs() > tol
+        return cls(conceptor.U[:, keep], conceptor.s[keep], conceptor.dim)
+
+    @classmethod
+    def from_tensors(cls, C=None, U=None, s=None):
+        """
+        Rebuilds a conceptor from its stored tensors, the dense matrix C or the factors U and s (the rank of a dense
+        conceptor is not kept)
+        """
+        conceptor = cls.__new__(cls)
+        conceptor.C, conceptor.U, conceptor.s = C, U, s
+        conceptor.dense = C is not None
+        conceptor.dim = C.size(0) if conceptor.dense else U.size(0)
+        conceptor.rank = None if conceptor.dense else s.size(0)
+        return conceptor
+
+    @property
+    def device(self):
+        return self.C.device if self.dense else self.U.device
+
+    def to(self, device):
+        conceptor = copy.copy(self)
+        for name in ["C", "U", "s"]:
+            if getattr(self, name) is not None:
+                setattr(conceptor, name, getattr(self, name).to(device))
+        return conceptor
+
+    def matrix(self):
+        if self.dense:
+            return self.C
+        return torch.matmul(self.U * self.s, self.U.T)
+
+    def eigen(self):
+        return EigenConceptor.from_matrix(self.matrix())
+
+    def addmm_(self, out, grad, alpha=1):
+        """
+        In-place out += alpha * grad C, used to fuse the projection into a parameter update
+        """
+        if self.dense:
+            return out.addmm_(grad, self.C, alpha=alpha)
+        if self.rank == 0:
+            return out
+        return out.addmm_(torch.matmul(grad, self.U) * self.s, self.U.T, alpha=alpha)
+
+    def project(self, grad):
+        """
+        Removes the component of grad (out, d) spanned by the conceptor: G - G C
+        """
+        if self.dense:
+            return grad - torch.matmul(grad, self.C)
+        if self.rank == 0:
+            return grad
+        return grad - torch.matmul(torch.matmul(grad, self.U) * self.s, self.U.T)
+
+
+def aperture_search(data, aperture, memory_threshold, gain=1.1, max_steps=2000, num_candidates=32, correlation=None,
+                    eig=None):
+    """
+    Closed-form replacement of the loop that adapts the aperture of compute_conceptor(data, aperture) by a fixed gain
+    until ||C x|| / ||x|| (summed over the columns of data) reaches memory_threshold. Adapting the aperture k times by
+    gain gives the conceptor of aperture aperture * gain**k, so R = X X^T / N is eigendecomposed once and the ratio of
+    any candidate k is computed from the spectrum and the energy of X in the eigenbasis. Candidates are scored in
+    batches of num_candidates (multisection search), without forming any d x d matrix.
+    :param data: (d, N) matrix with one sample per column, or an iterable of (d, n) column blocks (re-read on every
+    search round, so the columns never need to be materialized together)
+    :param aperture: initial aperture
+    :param memory_threshold: target reconstruction ratio
+    :param gain: aperture gain per step of the original loop
+    :param max_steps: maximum number of gain steps
+    :param num_candidates: number of candidate steps scored per search round
+    :param correlation: correlation matrix used instead of X X^T / N (e.g. accumulated over more samples than data)
+    :param eig: precomputed (eigenvalues, eigenvectors) of the correlation matrix
+    :return: conceptor (EigenConceptor), number of gain steps k, number of search rounds
+    """
+    blocks = [data] if torch.is_tensor(data) else data
+    total, count, xxt = 0, 0, 0
+    for X in blocks:
+        total = total + torch.norm(X, dim=0).sum()
+        count += X.size(1)
+        if correlation is None and eig is None:
+            xxt = xxt + torch.matmul(X, X.T)
+    if eig is None:
+        if correlation is None:
+            correlation = xxt / count
+        eig = torch.linalg.eigh(correlation.to(device=total.device, dtype=total.dtype))
+    lam, U = eig
+    lam = torch.clamp(lam, min=0)
+    # The energy of the columns in the eigenbasis is kept when data is a single matrix, recomputed per block otherwise
+    energy = torch.matmul(U.T, data) ** 2 if torch.is_tensor(data) else None
+
+    def spectrum(steps):
+        steps = steps.unsqueeze(1)
+        # (aperture * gain**k)**-2 computed in log space and float64, it under/overflows in float32 after a few hundred
+        # steps (0/0 on the zero eigenvalues)
+        regularizer = torch.exp(-2 * (math.log(aperture) + steps.double() * math.log(gain)))
+        s = torch.nan_to_num(lam.double() / (lam.double() + regularizer), nan=0.0).to(lam.dtype)
+        # aperture_adaptation clamps the spectrum, compute_conceptor (k = 0) does not
+        return torch.where(steps > 0, torch.clamp(s, min=SVAL_MIN, max=SVAL_MAX), s)
+
+    def ratio(steps):
+        s2 = spectrum(steps) ** 2
+        if energy is not None:
+            return torch.sqrt(torch.matmul(s2, energy)).sum(dim=1) / total
+        num = 0
+        for X in blocks:
+            num = num + torch.sqrt(torch.matmul(s2, torch.matmul(U.T, X) ** 2)).sum(dim=1)
+        return num / total
+
+    lo, hi = -1, None  # largest step known to fail, smallest step known to pass
+    rounds = 0
+    while hi is None or hi - lo > 1:
+        top = max_steps if hi is None else hi - 1
+        steps = torch.linspace(lo + 1, top, min(num_candidates, top - lo), device=lam.device).round().long()
+        steps = torch.unique(steps)
+        met = ratio(steps) >= memory_threshold
+        rounds += 1
+        if met.any():
+            first = int(torch.nonzero(met)[0])
+            hi = int(steps[first])
+            lo = int(steps[first - 1]) if first > 0 else lo
+        elif hi is None:
+            logging.warning(f"Aperture search: memory threshold {memory_threshold} not reached after {max_steps} steps")
+            hi = max_steps
+        else:
+            lo = int(steps[-1])
+    return EigenConceptor(U, spectrum(torch.tensor([hi], device=lam.device))[0]), hi, rounds
+
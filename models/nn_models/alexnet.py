@@ -83,7 +83,7 @@ class AlexNet(BaseModel):
         x = self.maxpool(self.drop1(self.relu(self.bn2(x))))
         x = self.conv3(x, task_id=experience_id)
         x = self.maxpool(self.drop2(self.relu(self.bn3(x))))
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.fc1(x, task_id=experience_id)
         x = self.drop2(self.relu(self.bn4(x)))
         x = self.fc2(x, task_id=experience_id)
@@ -91,6 +91,21 @@ class AlexNet(BaseModel):
         y_pred = self.fc3[experience_id](x)
         return y_pred
 
+    def forward_multi(self, x, task_ids):
+        x = self.conv1.forward_multi(x, task_ids)
+        x = self.maxpool(self.drop1(self.relu(self.bn1(x))))
+        x = self.conv2.forward_multi(x, task_ids)
+        x = self.maxpool(self.drop1(self.relu(self.bn2(x))))
+        x = self.conv3.forward_multi(x, task_ids)
+        x = self.maxpool(self.drop2(self.relu(self.bn3(x))))
+        x = x.reshape(x.size(0), -1)
+        x = self.fc1.forward_multi(x, task_ids)
+        x = self.drop2(self.relu(self.bn4(x)))
+        x = self.fc2.forward_multi(x, task_ids)
+        x = self.drop2(self.relu(self.bn5(x)))
+        y_pred = self.forward_heads(self.fc3, x, task_ids)
+        return y_pred
+
     def forward_all_layers(self, x0, experience_id=None):
         x = self.conv1(x0, task_id=experience_id)
         x1 = self.maxpool(self.drop1(self.relu(self.bn1(x))))
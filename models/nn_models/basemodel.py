@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+from .layers import CustomConv2d, CustomLinear, FoldedWeightCache
 
 __all__ = ['BaseModel']
 
@@ -29,3 +30,51 @@ class BaseModel(nn.Module):
     def forward_all_layers(self, x, experience_id=None):
         raise NotImplementedError
 
+    def forward_multi(self, x, task_ids):
+        """
+        Forward of a batch mixing tasks, task_ids is the tensor of the task of each sample
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def forward_heads(heads, x, task_ids):
+        """
+        Applies to each sample the head of its task, gathering the selected head weights into a single bmm
+        """
+        weight = torch.stack([head.weight for head in heads])[task_ids]
+        y_pred = torch.bmm(weight, x.unsqueeze(2)).squeeze(2)
+        if heads[0].bias is not None:
+            y_pred = y_pred + torch.stack([head.bias for head in heads])[task_ids]
+        return y_pred
+
+    def conceptor_layers(self):
+        """
+        Layers whose weight gradient is projected by their conceptor (see update_gradient)
+        """
+        return [m for m in self.modules() if isinstance(m, (CustomConv2d, CustomLinear))]
+
+    def register_gradient_hooks(self):
+        """
+        Projects the gradients of the conceptor layers during the backward pass, returns the hook handles
+        """
+        return [layer.register_gradient_hook() for layer in self.conceptor_layers()]
+
+    def enable_weight_cache(self, max_bytes=2 ** 30):
+        """
+        Reuses the per-task effective weights of the conceptor layers at inference, in an LRU cache of max_bytes
+        """
+        cache = FoldedWeightCache(max_bytes)
+        for layer in self.conceptor_layers():
+            layer.weight_cache = cache
+        return cache
+
+    def disable_weight_cache(self):
+        for layer in self.conceptor_layers():
+            layer.weight_cache = None
+
+    def frozen_parameters(self):
+        """
+        Parameters kept fixed after the first task (the BatchNorm layers, whose gradients update_gradient clears)
+        """
+        return [p for m in self.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) for p in m.parameters()]
+
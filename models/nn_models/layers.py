@@ -1,8 +1,175 @@
 import torch
 from torch import nn
+from collections import OrderedDict
 from ..conceptor_operations import *
+from ..conceptor_eigen import FactoredConceptor
+
+__all__ = ["CustomConv2d", "CustomLinear", "FoldedWeightCache"]
+
+
+def init_free_dims(layer, dim, num_free_dim, device=None):
+    """
+    Packed storage of the free dimensions of the tasks in region 2: the d x k bases Uw are the columns
+    idx_low:idx_high of the free_basis buffer and the k x k scales the rows idx_low:idx_high of the scale parameter,
+    with conceptor_intersection[task_id] = [idx_low, idx_high]. Both grow when a task is added (add_free_dims)
+    """
+    layer.num_free_dim = num_free_dim
+    layer.scale = nn.Parameter(torch.empty(0, num_free_dim, device=device))
+    layer.register_buffer('free_basis', torch.empty(dim, 0, device=device))
+    layer.register_buffer('free_tasks', torch.empty(0, dtype=torch.long, device=device))
+    layer.conceptor_intersection = {}
+    layer.index = 0
+
+
+def add_free_dims(layer, task_id, U):
+    """
+    Appends the free dimensions U (d x k) of task_id and a new k x k scale, initialized as nn.Linear(k, k) weights
+    """
+    k = layer.num_free_dim
+    scale = torch.empty(k, k, device=layer.scale.device).uniform_(-k ** -0.5, k ** -0.5)
+    layer.scale = nn.Parameter(torch.cat([layer.scale.data, scale]))
+    layer.free_basis = torch.cat([layer.free_basis, U.to(layer.free_basis)], dim=1)
+    layer.free_tasks = torch.cat([layer.free_tasks, layer.free_tasks.new_tensor([task_id])])
+    layer.conceptor_intersection[task_id] = [layer.index, int(layer.index + k)]
+    layer.index = int(layer.index + k)
+
+
+def load_free_dims(layer, state_dict, prefix):
+    """
+    Resizes the packed free dimensions to the ones of state_dict before loading it
+    """
+    if prefix + 'free_tasks' not in state_dict or state_dict[prefix + 'free_tasks'].shape == layer.free_tasks.shape:
+        return
+    free_tasks = state_dict[prefix + 'free_tasks']
+    layer.scale = nn.Parameter(layer.scale.data.new_empty(state_dict[prefix + 'scale'].shape))
+    layer.free_basis = layer.free_basis.new_empty(state_dict[prefix + 'free_basis'].shape)
+    layer.free_tasks = layer.free_tasks.new_empty(free_tasks.shape)
+    k = layer.num_free_dim
+    layer.conceptor_intersection = {t: [i * k, (i + 1) * k] for i, t in enumerate(free_tasks.tolist())}
+    layer.index = len(free_tasks) * k
+
+
+def init_basis(layer):
+    """
+    Memory of the layer, stored in buffers (the dense matrix basis_C or the factors basis_U, basis_s of the
+    FactoredConceptor). All None until the first conceptor: no constraint, the gradient is not projected
+    """
+    layer.register_buffer('basis_C', None)
+    layer.register_buffer('basis_U', None)
+    layer.register_buffer('basis_s', None)
+
+
+def get_basis(layer):
+    if layer.basis_C is None and layer.basis_U is None:
+        return None
+    return FactoredConceptor.from_tensors(layer.basis_C, layer.basis_U, layer.basis_s)
+
+
+def set_basis(layer, conceptor):
+    if conceptor is None:
+        layer.basis_C, layer.basis_U, layer.basis_s = None, None, None
+        return
+    conceptor = conceptor.to(layer.weight.device)
+    layer.basis_C, layer.basis_U, layer.basis_s = conceptor.C, conceptor.U, conceptor.s
+
+
+def load_basis(layer, state_dict, prefix):
+    """
+    Allocates (or releases) the basis buffers to match state_dict before loading it
+    """
+    for name in ['basis_C', 'basis_U', 'basis_s']:
+        tensor = state_dict.get(prefix + name)
+        if tensor is None:
+            setattr(layer, name, None)
+        elif getattr(layer, name) is None or getattr(layer, name).shape != tensor.shape:
+            setattr(layer, name, torch.empty(tensor.shape, dtype=tensor.dtype, device=layer.weight.device))
+
+
+def free_dims(layer, task_id):
+    """
+    Free-dimension basis Uw (d x k) and scale (k x k) of task_id
+    """
+    idx_low, idx_high = layer.conceptor_intersection[task_id]
+    return layer.free_basis[:, idx_low:idx_high], layer.scale[idx_low:idx_high]
+
+
+def free_dim_update(weight, U, scale, detach=True):
+    """
+    Free-dimension adapter of the (out, d) weight in factored form: W U S U^T - W U U^T = (W U S - W U) U^T, with
+    the k x k scale S. Costs O(out d k) instead of building d x d matrices.
+    Returns the (out, k) left factor, to be multiplied by U^T
+    :param detach: do not backpropagate through the W U U^T term
+    """
+    WU = torch.matmul(weight, U)
+    return torch.matmul(WU, scale) - (WU.detach() if detach else WU)
+
+
+def grouped_forward(layer, input, task_ids):
+    """
+    Forward of a batch whose samples belong to the tasks task_ids (tensor of size batch). The samples of the tasks
+    without free-dimension adapter share the weight of the layer, the others are grouped by task
+    """
+    tasks = [t for t in task_ids.unique().tolist() if t in layer.conceptor_intersection.keys()]
+    if not tasks:
+        return layer(input)
+    if len(tasks) == 1 and bool((task_ids == tasks[0]).all()):
+        return layer(input, task_id=tasks[0])
+    groups = [(None, ~torch.isin(task_ids, torch.tensor(tasks, device=task_ids.device)))]
+    groups += [(t, task_ids == t) for t in tasks]
+    out = None
+    for task_id, mask in groups:
+        idx = mask.nonzero().squeeze(1)
+        if idx.numel() == 0:
+            continue
+        y = layer(input[idx], task_id=task_id)
+        if out is None:
+            out = y.new_empty((input.size(0),) + y.shape[1:])
+        out[idx] = y
+    return out
+
+
+class FoldedWeightCache(object):
+    """
+    LRU cache of the effective weights of CustomLinear/CustomConv2d layers (weight normalization and free-dimension
+    adapter folded in), keyed by layer and task id and bounded by max_bytes. Used at inference only (no grad). An entry
+    is rebuilt when the parameters it was folded from are modified (version counter or storage change)
+    """
+
+    def __init__(self, max_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, layer, task_id):
+        adapter = task_id in layer.conceptor_intersection.keys()
+        if not adapter and not layer.weight_normalization:
+            return layer.weight
+        params = [layer.weight] + ([layer.scale, layer.free_basis] if adapter else [])
+        stamp = tuple((p._version, p.data_ptr()) for p in params)
+        key = (layer, task_id)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] == stamp:
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.pop(key)
+        weight = layer.effective_weight(task_id)
+        nbytes = weight.numel() * weight.element_size()
+        if nbytes <= self.max_bytes:
+            self.entries[key] = (stamp, weight)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self.pop(next(iter(self.entries)))
+        return weight
+
+    def pop(self, key):
+        stamp, weight = self.entries.pop(key)
+        self.nbytes -= weight.numel() * weight.element_size()
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
 
-__all__ = ["CustomConv2d", "CustomLinear"]
 
 class CustomLinear(nn.Linear):
     def __init__(self,
@@ -22,42 +189,57 @@ class CustomLinear(nn.Linear):
         self.in_features = in_features
         self.n_experiences = n_experiences
         self.n_classes = n_classes
-        self.basis_in = 0 * torch.eye(in_features).cuda()
-        self.basis_out = 0 * torch.eye(out_features).cuda()
+        init_basis(self)
         self.mode = mode
         self.previous_weights = 0
         self.last_layer = last_layer
         self.threshold = threshold
         self.aperture = aperture
         self.operation_region = 1
-        self.num_free_dim = num_free_dim
-
-        self.scale = torch.nn.ModuleList()
-        for t in range(20):
-            self.scale.append(torch.nn.Linear(num_free_dim, num_free_dim, bias=False))
-
-        self.conceptor_intersection = {}
-
-        self.index = 0
+        init_free_dims(self, in_features, num_free_dim)
 
         self.eps = 1e-4
         self.gain = None
         self.weight_normalization = weight_normalization
+        # Shared FoldedWeightCache used at inference (see BaseModel.enable_weight_cache)
+        self.weight_cache = None
+
+    @property
+    def basis_in(self):
+        return get_basis(self)
+
+    @basis_in.setter
+    def basis_in(self, conceptor):
+        set_basis(self, conceptor)
 
     def measure_tasks_similarity(self, task_id, conceptor):
-        ratio = measure_conceptor_capacity(and_operation(self.basis_in, conceptor))
-        ratio = ratio / measure_conceptor_capacity(self.basis_in)
+        if self.basis_in is None:
+            return
+        # The similarity is computed on the device of the new conceptor
+        basis_in = self.basis_in.to(conceptor.device).eigen()
+        C_intersection = basis_in.and_operation(conceptor.eigen())
+        ratio = C_intersection.capacity() / basis_in.capacity()
         if ratio > 0.5 and self.in_features > 50 and self.num_free_dim > 0:
-            C_intersection = and_operation(self.basis_in, conceptor)
-            U, S, _ = torch.svd(C_intersection)
-            self.conceptor_intersection[task_id] = [U[:, :self.num_free_dim], self.index, int(self.index + self.num_free_dim)]
-            self.index = int(self.index + self.num_free_dim)
+            add_free_dims(self, task_id, C_intersection.principal_directions(self.num_free_dim))
 
     def update_basis(self, basis_in):
-        self.basis_in = basis_in
+        set_basis(self, basis_in)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        load_basis(self, state_dict, prefix)
+        load_free_dims(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def update_gradient(self):
-        self.weight.grad.data = self.weight.grad.data - torch.matmul(self.weight.grad.data, self.basis_in)
+        if self.basis_in is None:
+            return
+        self.weight.grad.data = self.basis_in.project(self.weight.grad.data)
+
+    def register_gradient_hook(self):
+        """
+        Projects the weight gradient (update_gradient) as soon as it is accumulated during the backward pass
+        """
+        return self.weight.register_post_accumulate_grad_hook(lambda weight: self.update_gradient())
 
     def get_weight(self):
         if self.weight_normalization:
@@ -71,15 +253,24 @@ class CustomLinear(nn.Linear):
             weight = self.weight
         return weight
 
-    def forward(self, input: torch.Tensor, task_id=None):
-        proj_weights = 0
+    def effective_weight(self, task_id=None):
+        weight = self.get_weight()
         if task_id in self.conceptor_intersection.keys():
-            Uw, idx_low, idx_high = self.conceptor_intersection[task_id]
-            proj_weights = torch.matmul(self.weight, torch.matmul(Uw, self.scale[task_id](Uw).T))
-            proj_weights = proj_weights - torch.matmul(self.weight.detach(), torch.matmul(Uw, Uw.T))
-        out = nn.functional.linear(input, self.get_weight() + proj_weights, self.bias)
+            Uw, scale = free_dims(self, task_id)
+            weight = torch.addmm(weight, free_dim_update(self.weight, Uw, scale), Uw.T)
+        return weight
+
+    def forward(self, input: torch.Tensor, task_id=None):
+        if self.weight_cache is not None and not torch.is_grad_enabled():
+            weight = self.weight_cache.get(self, task_id)
+        else:
+            weight = self.effective_weight(task_id)
+        out = nn.functional.linear(input, weight, self.bias)
         return out
 
+    def forward_multi(self, input: torch.Tensor, task_ids: torch.Tensor):
+        return grouped_forward(self, input, task_ids)
+
 
 
 class CustomConv2d(nn.Conv2d):
@@ -109,8 +300,7 @@ class CustomConv2d(nn.Conv2d):
                                            padding_mode, device, None)
         self.n_experiences = n_experiences
         self.n_classes = n_classes
-        self.basis_in = 0 * torch.eye(in_channels*kernel_size*kernel_size).cuda()
-        self.basis_out = 0 * torch.eye(out_channels).cuda()
+        init_basis(self)
         self.mode = mode
         self.previous_weights = 0
         self.last_layer = last_layer
@@ -118,35 +308,53 @@ class CustomConv2d(nn.Conv2d):
         self.threshold = threshold
         self.aperture = aperture
         self.operation_region = 1
-        self.num_free_dim = num_free_dim
-        self.scale = torch.nn.ModuleList()
-        for t in range(20):
-            self.scale.append(torch.nn.Linear(num_free_dim, num_free_dim, bias=False))
-
-        self.conceptor_intersection = {}
-        self.index = 0
+        init_free_dims(self, in_channels * kernel_size * kernel_size, num_free_dim, device=device)
 
         self.gain = None
         self.eps = 1e-4
         self.weight_normalization = weight_normalization
+        # Shared FoldedWeightCache used at inference (see BaseModel.enable_weight_cache)
+        self.weight_cache = None
+
+    @property
+    def basis_in(self):
+        return get_basis(self)
+
+    @basis_in.setter
+    def basis_in(self, conceptor):
+        set_basis(self, conceptor)
 
     def measure_tasks_similarity(self, task_id, conceptor):
-        ratio = measure_conceptor_capacity(and_operation(self.basis_in, conceptor))
-        ratio = ratio / measure_conceptor_capacity(self.basis_in)
+        if self.basis_in is None:
+            return
+        # The similarity is computed on the device of the new conceptor
+        basis_in = self.basis_in.to(conceptor.device).eigen()
+        C_intersection = basis_in.and_operation(conceptor.eigen())
+        ratio = C_intersection.capacity() / basis_in.capacity()
         if ratio > 0.5 and (self.kernel_size**2)*self.in_channels > self.num_free_dim and self.num_free_dim > 0:
-            print(f"Layer {conceptor.size(0)} in Region 2")
+            print(f"Layer {conceptor.dim} in Region 2")
             self.operation_region = 2
-            C_intersection = and_operation(self.basis_in, conceptor)
-            U, S, _ = torch.svd(C_intersection)
-            self.conceptor_intersection[task_id] = [U[:, :self.num_free_dim], self.index, int(self.index + self.num_free_dim)]
-            self.index = int(self.index + self.num_free_dim)
+            add_free_dims(self, task_id, C_intersection.principal_directions(self.num_free_dim))
             print(self.conceptor_intersection.keys())
 
     def update_basis(self, basis_in):
-        self.basis_in = basis_in
+        set_basis(self, basis_in)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        load_basis(self, state_dict, prefix)
+        load_free_dims(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def update_gradient(self):
-        self.weight.grad.data = self.weight.grad.data - torch.matmul(self.weight.grad.data.view(self.weight.grad.data.size(0), -1), self.basis_in).view_as(self.weight)
+        if self.basis_in is None:
+            return
+        self.weight.grad.data = self.basis_in.project(self.weight.grad.data.view(self.weight.grad.data.size(0), -1)).view_as(self.weight)
+
+    def register_gradient_hook(self):
+        """
+        Projects the weight gradient (update_gradient) as soon as it is accumulated during the backward pass
+        """
+        return self.weight.register_post_accumulate_grad_hook(lambda weight: self.update_gradient())
 
     def get_weight(self):
         if self.weight_normalization:
@@ -160,13 +368,24 @@ class CustomConv2d(nn.Conv2d):
             weight = self.weight
         return weight
 
-    def forward(self, input: torch.Tensor, task_id=None):
+    def effective_weight(self, task_id=None):
         out_channels = self.weight.size(0)
-        proj_weights = 0
+        weight = self.get_weight()
         if task_id in self.conceptor_intersection.keys():
-            Uw, idx_low, idx_high = self.conceptor_intersection[task_id]
-            proj_weights = torch.matmul(self.weight.view(out_channels, -1), torch.matmul(Uw, self.scale[task_id](Uw).T)).view_as(self.weight)
-            proj_weights = proj_weights - torch.matmul(self.weight.view(out_channels, -1), torch.matmul(Uw, Uw.T)).view_as(self.weight)
+            Uw, scale = free_dims(self, task_id)
+            weight = torch.addmm(weight.view(out_channels, -1),
+                                 free_dim_update(self.weight.view(out_channels, -1), Uw, scale, detach=False),
+                                 Uw.T).view_as(self.weight)
+        return weight
+
+    def forward(self, input: torch.Tensor, task_id=None):
+        if self.weight_cache is not None and not torch.is_grad_enabled():
+            weight = self.weight_cache.get(self, task_id)
+        else:
+            weight = self.effective_weight(task_id)
+
+        out = nn.functional.conv2d(input, weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+        return out
 
-        out = nn.functional.conv2d(input, self.get_weight() + proj_weights, self.bias, self.stride, self.padding, self.dilation, self.groups)
-        return out
\ No newline at end of file
+    def forward_multi(self, input: torch.Tensor, task_ids: torch.Tensor):
+        return grouped_forward(self, input, task_ids)
\ No newline at end of file
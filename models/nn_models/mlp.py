@@ -32,12 +32,19 @@ class MLP(BaseModel):
         self.fc3.update_gradient()
 
     def forward(self, x, labels=None, experience_id=None):
-        x = x.view(x.shape[0], -1)
+        x = x.reshape(x.shape[0], -1)
         x = torch.relu(self.fc1(x, task_id=experience_id))
         x = torch.relu(self.fc2(x, task_id=experience_id))
         y_pred = self.fc3(x, task_id=experience_id)
         return y_pred
 
+    def forward_multi(self, x, task_ids):
+        x = x.reshape(x.shape[0], -1)
+        x = torch.relu(self.fc1.forward_multi(x, task_ids))
+        x = torch.relu(self.fc2.forward_multi(x, task_ids))
+        y_pred = self.fc3.forward_multi(x, task_ids)
+        return y_pred
+
     def forward_all_layers(self, x, experience_id=None):
         x0 = x.view(x.shape[0], -1)
         x1 = torch.relu(self.fc1(x0, task_id=experience_id))
@@ -41,6 +41,13 @@ class BasicBlock(nn.Module):
         out = torch.relu(out)
         return out
 
+    def forward_multi(self, x, task_ids):
+        out = torch.relu(self.bn1(self.conv1.forward_multi(x, task_ids)))
+        out = self.bn2(self.conv2.forward_multi(out, task_ids))
+        out += self.bn3(self.shortcut(x))
+        out = torch.relu(out)
+        return out
+
     def forward_all_layers(self, x0, experience_id=None):
         x1 = torch.relu(self.bn1(self.conv1(x0, experience_id)))
         x2 = self.bn2(self.conv2(x1, experience_id))
@@ -201,10 +208,25 @@ class ResNet(BaseModel):
         out = self.block7(out, experience_id)
         out = self.block8(out, experience_id)
         out = torch.nn.AdaptiveAvgPool2d((2,2))(out)
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         y_pred = self.linear[experience_id](out)
         return y_pred
 
+    def forward_multi(self, x, task_ids):
+        out = torch.relu(self.bn1(self.conv1.forward_multi(x, task_ids)))
+        out = self.block1.forward_multi(out, task_ids)
+        out = self.block2.forward_multi(out, task_ids)
+        out = self.block3.forward_multi(out, task_ids)
+        out = self.block4.forward_multi(out, task_ids)
+        out = self.block5.forward_multi(out, task_ids)
+        out = self.block6.forward_multi(out, task_ids)
+        out = self.block7.forward_multi(out, task_ids)
+        out = self.block8.forward_multi(out, task_ids)
+        out = torch.nn.AdaptiveAvgPool2d((2,2))(out)
+        out = out.reshape(out.size(0), -1)
+        y_pred = self.forward_heads(self.linear, out, task_ids)
+        return y_pred
+
     def forward_all_layers(self, x0, experience_id=None):
         bsz = x0.size(0)
         x1 = torch.relu(self.bn1(self.conv1(x0, experience_id)))
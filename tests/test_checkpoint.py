@@ -0,0 +1,87 @@
+"""
+Checkpoint, crash and --resume of a run: the resumed run reopens the mlflow run of the checkpoint and continues with the
+same state as the run that was not interrupted
+"""
+import os
+import mlflow
+import pytest
+import torch
+from torch import nn
+from torch.utils.data import TensorDataset
+from cl_method.strategy import MyStrategy
+from models.nn_models import AlexNet
+from utils import CheckpointWriter, experience_state, load_checkpoint, resume_point, set_rng_state, log_run_params
+
+
+def make_strategy():
+    torch.manual_seed(0)
+    model = AlexNet(n_classes=5, n_experiences=2, num_free_dim=20)
+    return MyStrategy(model, None, nn.CrossEntropyLoss(), epochs=1, batch_size=32, threshold=[0, 0],
+                      aperture=[4] * 6, dropout=True, basis_bs=64, model_name='AlexNet', lr=0.05, print_freq=1000,
+                      device='cpu')
+
+
+@pytest.fixture
+def tasks():
+    generator = torch.Generator().manual_seed(0)
+    tasks = []
+    for t in range(2):
+        x = torch.randn(64, 3, 32, 32, generator=generator) + 0.3 * t
+        tasks.append(TensorDataset(x, torch.randint(0, 5, (64,), generator=generator)))
+    return tasks
+
+
+@pytest.fixture
+def tracking(tmp_path):
+    mlflow.set_tracking_uri("file:" + str(tmp_path / "mlruns"))
+    mlflow.set_experiment("test_checkpoint")
+    yield tmp_path
+    mlflow.end_run()
+    mlflow.set_tracking_uri(None)
+
+
+def test_log_run_params_resumed(tracking):
+    with mlflow.start_run() as run:
+        log_run_params({'resume': None, 'save_path': 'a', 'lr': 0.1})
+    with mlflow.start_run(run_id=run.info.run_id):
+        log_run_params({'resume': 'a', 'save_path': 'b', 'lr': 0.1, 'amp': 'bf16'})
+    params = mlflow.get_run(run.info.run_id).data.params
+    assert params == {'resume': 'None', 'save_path': 'a', 'lr': '0.1', 'amp': 'bf16'}
+
+
+def test_checkpoint_crash_resume(tracking, tasks):
+    path = os.path.join(tracking, "checkpoint.pt")
+    params = {'resume': None, 'save_path': str(tracking), 'lr': 0.05}
+
+    # Run interrupted after the basis update of the first experience
+    with pytest.raises(KeyboardInterrupt):
+        with mlflow.start_run() as run:
+            log_run_params(params)
+            cl_strategy = make_strategy()
+            checkpoint = CheckpointWriter(path, async_write=True)
+            cl_strategy.train(tasks[0], tasks[0])
+            accuracy_history = [[cl_strategy.testing(tasks[0], test_id=0)]]
+            checkpoint.save(experience_state(cl_strategy, 0, 'evaluated', accuracy_history))
+            cl_strategy.update_basis(tasks[0], 0)
+            checkpoint.save(experience_state(cl_strategy, 0, 'basis', accuracy_history))
+            checkpoint.wait()
+            state = {key: value.clone() for key, value in cl_strategy.model.state_dict().items()}
+            # Run that is not interrupted
+            cl_strategy.train(tasks[1], tasks[1])
+            expected = [cl_strategy.testing(tasks[k], test_id=k) for k in range(2)]
+            raise KeyboardInterrupt
+
+    # Resumed run
+    checkpoint_resume = load_checkpoint(path)
+    assert checkpoint_resume['run_id'] == run.info.run_id
+    assert resume_point(checkpoint_resume) == (1, False)
+    with mlflow.start_run(run_id=checkpoint_resume['run_id']):
+        log_run_params(dict(params, resume=str(tracking), save_path=str(tracking) + "_resumed"))
+        cl_strategy = make_strategy()
+        cl_strategy.load_state_dict(checkpoint_resume['strategy'])
+        set_rng_state(checkpoint_resume['rng'])
+        assert checkpoint_resume['accuracy_history'] == accuracy_history
+        for key, value in cl_strategy.model.state_dict().items():
+            assert torch.equal(value, state[key]), key
+        cl_strategy.train(tasks[1], tasks[1])
+        assert [cl_strategy.testing(tasks[k], test_id=k) for k in range(2)] == expected
@@ -0,0 +1,26 @@
+"""
+Conv patch correlations computed without unfold against the unfolded input
+"""
+import pytest
+import torch
+from cl_method.code_cl import ConvPatches, layer_activation, patch_correlation
+
+CONFIGS = [(1, 1, 0), (2, 1, 0), (3, 1, 1), (3, 2, 1), (4, 1, 0), (5, 1, 2), (5, 2, 0)]
+
+
+@pytest.mark.parametrize("kernel_size, stride, padding", CONFIGS)
+@pytest.mark.parametrize("max_elements", [2 ** 24, 5000])
+def test_patch_correlation(kernel_size, stride, padding, max_elements):
+    x = torch.randn(7, 4, 11, 9, generator=torch.Generator().manual_seed(0), dtype=torch.float64)
+    activation = layer_activation(x, kernel_size, stride, padding)
+    R, count = patch_correlation(x, kernel_size, stride, padding, max_elements=max_elements)
+    assert count == activation.size(1)
+    assert torch.allclose(R, activation @ activation.T, rtol=0, atol=1e-10)
+
+
+def test_conv_patches():
+    x = torch.randn(6, 3, 8, 8, generator=torch.Generator().manual_seed(0), dtype=torch.float64)
+    patches = ConvPatches(x, 3, 1, 1, max_elements=3000)
+    activation = layer_activation(x, 3, 1, 1)
+    assert torch.equal(torch.cat(list(patches), dim=1), activation)
+    assert torch.allclose(patches.correlation(), activation @ activation.T / activation.size(1), rtol=0, atol=1e-12)
@@ -0,0 +1,107 @@
+"""
+Parity of the eigen-form conceptor operations (models/conceptor_eigen.py) with the dense operations of
+models/conceptor_operations.py, in float64 on CPU
+"""
+import pytest
+import torch
+from models.conceptor_eigen import EigenConceptor, FactoredConceptor, aperture_search
+from models.conceptor_operations import *
+
+SIZES = [(30, 200), (64, 40), (144, 500)]
+
+
+@pytest.fixture(scope="module", params=SIZES, ids=lambda size: "d{}-n{}".format(*size))
+def conceptors(request):
+    d, n = request.param
+    generator = torch.Generator().manual_seed(d * n)
+    X1 = torch.randn(d, n, dtype=torch.float64, generator=generator)
+    X2 = torch.randn(d, d, dtype=torch.float64, generator=generator) @ torch.randn(d, n, dtype=torch.float64,
+                                                                                   generator=generator) / d
+    return {'X1': X1, 'X2': X2,
+            'C1': compute_conceptor(X1, aperture=4), 'C2': compute_conceptor(X2, aperture=8),
+            'E1': EigenConceptor.from_data(X1, aperture=4), 'E2': EigenConceptor.from_data(X2, aperture=8)}
+
+
+def low_rank(c):
+    return c['E1'].lower_bound(0.5), c['E2'].lower_bound(0.5)
+
+
+def to_float(E):
+    return EigenConceptor(E.U.float(), E.s.float())
+
+
+# name: (eigen result, dense result, tolerance)
+OPERATIONS = {
+    'compute_conceptor': lambda c: (c['E1'].matrix(), c['C1'], 1e-4),
+    'not_operation': lambda c: (c['E1'].not_operation().matrix(), not_operation(c['C1']), 1e-4),
+    'aperture_adaptation': lambda c: (c['E1'].aperture_adaptation(1.1).matrix(),
+                                      aperture_adaptation(c['C1'], 1.1), 1e-4),
+    'and_operation': lambda c: (c['E1'].and_operation(c['E2']).matrix(), and_operation(c['C1'], c['C2']), 1e-4),
+    'or_operation': lambda c: (c['E1'].or_operation(c['E2']).matrix(), or_operation(c['C1'], c['C2']), 1e-4),
+    'measure_conceptor_capacity': lambda c: (c['E1'].capacity(), measure_conceptor_capacity(c['C1']), 1e-4),
+    'similarity': lambda c: (c['E1'].similarity(c['E2']), similarity(c['C1'], c['C2']), 1e-4),
+    'conceptor_to_correlation': lambda c: (c['E1'].to_correlation(4).matrix(),
+                                           conceptor_to_correlation(c['C1'], 4), 1e-4),
+    'incremental_conceptor_extension': lambda c: (
+        c['E1'].aperture_adaptation(2 ** 0.5 / 4).or_operation(c['E2']).aperture_adaptation(3 ** 0.5 * 4).matrix(),
+        incremental_conceptor_extension(c['C1'], c['C2'], 2, 1, aperture=4), 1e-4),
+    # Rank-deficient conceptors, as produced by the lower singular value bound in code_cl.update_basis
+    'and_operation_low_rank': lambda c: (low_rank(c)[0].and_operation(low_rank(c)[1]).matrix(),
+                                         and_operation(low_rank(c)[0].matrix(), low_rank(c)[1].matrix()), 1e-4),
+    'or_operation_low_rank': lambda c: (low_rank(c)[0].or_operation(c['E2']).matrix(),
+                                        or_operation(low_rank(c)[0].matrix(), c['E2'].matrix()), 1e-4),
+    'or_operation_float32': lambda c: (
+        to_float(low_rank(c)[0]).or_operation(to_float(low_rank(c)[1])).matrix().double(),
+        or_operation(low_rank(c)[0].matrix().float(), low_rank(c)[1].matrix().float()).double(), 1e-3),
+}
+
+
+@pytest.mark.parametrize("name", list(OPERATIONS))
+def test_operation(conceptors, name):
+    eigen, dense, atol = OPERATIONS[name](conceptors)
+    assert (eigen - dense).abs().max().item() < atol
+
+
+def test_aperture_search(conceptors):
+    # Gain loop previously in code_cl.update_basis
+    X2 = conceptors['X2']
+    C, loop_steps = compute_conceptor(X2, aperture=1), 0
+    while torch.norm(C @ X2, dim=0).sum() / torch.norm(X2, dim=0).sum() < 0.95:
+        C, loop_steps = aperture_adaptation(C, 1.1), loop_steps + 1
+    E, steps, rounds = aperture_search(X2, 1, 0.95, gain=1.1)
+    assert abs(steps - loop_steps) <= 1
+    assert (E.matrix() - C).abs().max().item() < 1e-4
+
+
+@pytest.mark.parametrize("bound", [0.95, None])
+def test_factored_projection(conceptors, bound):
+    E = conceptors['E1'] if bound is None else conceptors['E1'].lower_bound(bound)
+    G = torch.randn(17, E.U.size(0), dtype=torch.float64)
+    F = FactoredConceptor.from_eigen(E)
+    assert (F.project(G) - (G - G @ E.matrix())).abs().max().item() < 1e-4
+
+
+def test_or_operation_batched(conceptors):
+    # Stacked conceptors: one batched call for all the layers of the same size
+    L1, L2 = low_rank(conceptors)
+    E1, E2 = conceptors['E1'], conceptors['E2']
+    S1 = EigenConceptor.stack([L1, E1, E1.lower_bound(0.95)])
+    S2 = EigenConceptor.stack([E2, L2, E2])
+    OR = S1.or_operation(S2)
+    for j in range(3):
+        assert (OR[j].matrix() - or_operation(S1[j].matrix(), S2[j].matrix())).abs().max().item() < 1e-4
+
+
+@pytest.mark.parametrize("max_steps", [600, 2000])
+def test_aperture_search_unreached_threshold(max_steps):
+    # Rank-deficient float32 data and memory_threshold=1.0 (unreachable, the spectrum is clamped below 1): the search
+    # stops at max_steps, where (aperture * gain**k)**-2 is far below the float32 range
+    generator = torch.Generator().manual_seed(0)
+    X = torch.randn(128, 32, generator=generator) @ torch.randn(32, 300, generator=generator)
+    eig = torch.linalg.eigh(X @ X.T / X.size(1))
+    E, steps, rounds = aperture_search(X, 4, 1.0, gain=1.1, max_steps=max_steps, eig=eig)
+    lam = eig[0].double().clamp(min=0)
+    expected = (lam / (lam + (4 * 1.1 ** torch.tensor(float(steps), dtype=torch.float64)) ** -2)).clamp(1e-8, 0.9999999)
+    assert steps <= max_steps
+    assert not torch.isnan(E.s).any()
+    assert (E.s.double() - expected).abs().max().item() < 1e-6
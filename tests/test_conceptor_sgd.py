@@ -0,0 +1,75 @@
+"""
+ConceptorSGD and the gradient hooks against SGD after the explicit gradient projection (model.update_gradient)
+"""
+import pytest
+import torch
+from torch import nn
+from cl_method.conceptor_sgd import ConceptorSGD
+from models.conceptor_eigen import FactoredConceptor
+from models.nn_models import AlexNet
+
+LR = 0.05
+# Rank of the conceptor of each layer (conv1, conv2, conv3, fc1, fc2), dense above half the dimension
+RANKS = [40, 100, 400, 200, 0]
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = AlexNet(n_classes=5, n_experiences=2)
+    generator = torch.Generator().manual_seed(1)
+    for layer, rank in zip(model.conceptor_layers(), RANKS):
+        dim = layer.weight[0].numel()
+        U = torch.linalg.qr(torch.randn(dim, rank, generator=generator))[0]
+        layer.basis_in = FactoredConceptor(U, torch.rand(rank, generator=generator), dim)
+    # Batch statistics without dropout
+    model.eval()
+    return model
+
+
+@pytest.fixture
+def batch():
+    generator = torch.Generator().manual_seed(2)
+    return torch.randn(16, 3, 32, 32, generator=generator), torch.randint(0, 5, (16,), generator=generator)
+
+
+def backward(model, batch):
+    model.zero_grad()
+    nn.functional.cross_entropy(model(batch[0], experience_id=1), batch[1]).backward()
+
+
+def test_conceptor_sgd(batch):
+    reference = make_model()
+    assert [layer.basis_in.dense for layer in reference.conceptor_layers()] == [True, False, True, False, False]
+    backward(reference, batch)
+    reference.update_gradient()
+    torch.optim.SGD(reference.parameters(), lr=LR).step()
+
+    model = make_model()
+    backward(model, batch)
+    ConceptorSGD(model.parameters(), lr=LR, conceptor_layers=model.conceptor_layers(),
+                 frozen=model.frozen_parameters()).step()
+
+    for (name, p), q in zip(model.named_parameters(), reference.parameters()):
+        assert torch.allclose(p, q, rtol=0, atol=1e-6), name
+
+
+def test_gradient_hooks(batch):
+    reference = make_model()
+    backward(reference, batch)
+    reference.update_gradient()
+
+    model = make_model()
+    hooks = model.register_gradient_hooks()
+    backward(model, batch)
+    for layer, reference_layer in zip(model.conceptor_layers(), reference.conceptor_layers()):
+        assert torch.equal(layer.weight.grad, reference_layer.weight.grad)
+    # As in MyStrategy, the optimizer only skips the frozen parameters when the hooks project the gradients
+    ConceptorSGD(model.parameters(), lr=LR, conceptor_layers=[], frozen=model.frozen_parameters()).step()
+    torch.optim.SGD(reference.parameters(), lr=LR).step()
+    for (name, p), q in zip(model.named_parameters(), reference.parameters()):
+        assert torch.equal(p, q), name
+
+    for hook in hooks:
+        hook.remove()
+    backward(model, batch)
+    assert not torch.equal(model.fc1.weight.grad, model.fc1.basis_in.project(model.fc1.weight.grad))
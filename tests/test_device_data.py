@@ -0,0 +1,41 @@
+"""
+tensor_experience keeps the uint8 (memory-mapped) samples and normalizes them batch by batch
+"""
+import functools
+import numpy as np
+import torch
+from utils import DeviceDataLoader, tensor_experience
+from utils import cifar100, five_datasets
+
+
+def memmap_tensor(path, shape):
+    array = np.lib.format.open_memmap(str(path), mode='w+', dtype=np.uint8, shape=shape)
+    array[:] = np.random.RandomState(0).randint(0, 256, size=shape)
+    array.flush()
+    return torch.from_numpy(np.load(str(path), mmap_mode='c'))
+
+
+def test_lazy_normalization(tmp_path):
+    x = memmap_tensor(tmp_path / "x.npy", (100, 3, 32, 32))
+    y = torch.arange(100) % 10
+    dataset = tensor_experience(x, y, transform=cifar100.normalize)
+    # No float32 copy of the task: the samples stay in the memory map
+    assert dataset.tensors[0].dtype == torch.uint8
+    assert dataset.tensors[0].data_ptr() == x.data_ptr()
+    expected = cifar100.normalize(x.clone())
+    batches = list(DeviceDataLoader(dataset, batch_size=32))
+    assert torch.equal(torch.cat([batch[0] for batch in batches]), expected)
+    assert torch.equal(torch.cat([batch[1] for batch in batches]), y)
+
+
+def test_lazy_padding_shuffled(tmp_path):
+    x = memmap_tensor(tmp_path / "x.npy", (50, 1, 28, 28))
+    y = torch.arange(50)
+    transform = functools.partial(five_datasets.normalize, mean=(0.1,), std=(0.3,), size=32)
+    dataset = tensor_experience(x, y, transform=transform)
+    assert dataset.tensors[0].data_ptr() == x.data_ptr()
+    expected = transform(x.clone())
+    assert expected.shape == (50, 3, 32, 32)
+    inputs, labels = map(torch.cat, zip(*DeviceDataLoader(dataset, batch_size=16, shuffle=True)))
+    assert sorted(labels.tolist()) == list(range(50))
+    assert torch.equal(inputs, expected[labels])
@@ -0,0 +1,68 @@
+"""
+state_dict round-trip of the conceptor buffers and of the packed free dimensions of the conceptor layers
+"""
+import torch
+from models.conceptor_eigen import FactoredConceptor
+from models.nn_models import AlexNet
+from models.nn_models.layers import add_free_dims
+
+NUM_FREE_DIM = 4
+
+
+def make_model():
+    return AlexNet(n_classes=5, n_experiences=3, num_free_dim=NUM_FREE_DIM)
+
+
+def grow(model):
+    """
+    Dense and factored conceptors (conv1 left without one) and the free dimensions of tasks 1 and 2
+    """
+    generator = torch.Generator().manual_seed(0)
+    for layer, rank in zip(model.conceptor_layers()[1:], [400, 100, 200, 30]):
+        dim = layer.weight[0].numel()
+        U = torch.linalg.qr(torch.randn(dim, rank, generator=generator))[0]
+        layer.basis_in = FactoredConceptor(U, torch.rand(rank, generator=generator), dim)
+    for layer in [model.conv2, model.fc1, model.fc2]:
+        for task_id in [1, 2]:
+            dim = layer.weight[0].numel()
+            add_free_dims(layer, task_id, torch.linalg.qr(torch.randn(dim, NUM_FREE_DIM, generator=generator))[0])
+    model.fc1.scale.data.normal_(generator=generator)
+    return model
+
+
+def assert_same_state(model, reference):
+    state, reference_state = model.state_dict(), reference.state_dict()
+    assert state.keys() == reference_state.keys()
+    for key, value in reference_state.items():
+        assert torch.equal(state[key], value), key
+    for layer, reference_layer in zip(model.conceptor_layers(), reference.conceptor_layers()):
+        assert layer.conceptor_intersection == reference_layer.conceptor_intersection
+        assert layer.index == reference_layer.index
+        assert (layer.basis_in is None) == (reference_layer.basis_in is None)
+        if layer.basis_in is not None:
+            assert layer.basis_in.dense == reference_layer.basis_in.dense
+            assert torch.equal(layer.basis_in.matrix(), reference_layer.basis_in.matrix())
+
+
+def test_state_dict_round_trip():
+    torch.manual_seed(0)
+    reference = grow(make_model())
+    model = make_model()
+    model.load_state_dict(reference.state_dict())
+    assert_same_state(model, reference)
+    assert model.conv1.basis_in is None
+    x = torch.randn(8, 3, 32, 32)
+    reference.eval()
+    model.eval()
+    with torch.no_grad():
+        for task_id in range(3):
+            assert torch.equal(model(x, experience_id=task_id), reference(x, experience_id=task_id))
+
+
+def test_load_smaller_state():
+    torch.manual_seed(0)
+    reference = make_model()
+    model = grow(make_model())
+    model.load_state_dict(reference.state_dict())
+    assert_same_state(model, reference)
+    assert all(layer.basis_in is None and layer.free_basis.size(1) == 0 for layer in model.conceptor_layers())
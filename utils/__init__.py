@@ -1,3 +1,6 @@
 from .metrics import *
 from .five_datasets import *
 from .args import *
+from .device_data import *
+from .mini_imagenet import *
+from .checkpoint import *
@@ -1,4 +1,5 @@
 import argparse
+import torch
 
 __all__ = ["parse_args"]
 
@@ -11,11 +12,14 @@ def parse_args():
     parser.add_argument('--aperture', nargs='+', type=float, default=[4, 4, 4, 4, 4, 4],
                         help='Aperture parameter to compute conceptors.')
     parser.add_argument('--data-aug', action='store_true',
-                        help='Use data augmentation')
+                        help='Use data augmentation (random crop, flip and erasing of the training batches on the device)')
     parser.add_argument('--dropout', action='store_true',
                         help='Use dropout')
     parser.add_argument('--basis-batch-size', type=int, default=125,
                         help='Batch size for conceptor computation')
+    parser.add_argument('--basis-batches', type=int, default=1,
+                        help='Number of batches of size --basis-batch-size used to compute the conceptors '
+                             '(<= 0 uses the whole experience)')
     parser.add_argument('--avg-pool', action='store_true',
                         help='Use average pooling in the conceptor computation')
     parser.add_argument('--threshold-conv', type=float, default=0.95,
@@ -49,6 +53,25 @@ def parse_args():
                         help='Learning rate decay factor')
     parser.add_argument('--num-free-dim', type=int, default=0,
                         help='Number of free dimensions (K)')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device used for training and evaluation (e.g. cuda, cuda:1, cpu)')
+    parser.add_argument('--conceptor-device', type=str, default=None,
+                        help='Device used for the conceptor computations (defaults to --device)')
+    parser.add_argument('--grad-hooks', action='store_true',
+                        help='Project the gradients with hooks during the backward pass')
+    parser.add_argument('--weight-cache-mb', type=float, default=0,
+                        help='Size (MB) of the cache of per-task folded weights used at evaluation (0 disables it)')
+    parser.add_argument('--amp', type=str, choices=['bf16', 'fp16'], default=None,
+                        help='Mixed precision of the training forward/backward passes')
+    parser.add_argument('--compile-step', action='store_true',
+                        help='Compile the training step per task (CUDA graphs, channels_last inputs)')
+    parser.add_argument('--device-data', action='store_true',
+                        help='Keep the tasks of the tensor benchmarks (5-datasets, Split CIFAR-100, MiniImageNet) on the '
+                             'device')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='Folder of an interrupted run, restarted from its last checkpoint')
+    parser.add_argument('--async-checkpoint', action='store_true',
+                        help='Write the per-experience checkpoints in a background thread')
 
 
     args = parser.parse_args()
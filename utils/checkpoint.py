@@ -0,0 +1,108 @@
+import io
+import os
+import random
+import threading
+import numpy as np
+import torch
+import mlflow
+
+__all__ = ["CheckpointWriter", "load_checkpoint", "rng_state", "set_rng_state", "experience_state", "resume_point",
+           "log_run_params"]
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints atomically (temporary file, fsync, os.replace), so that a crash leaves the previous checkpoint
+    intact. The state is serialized when save is called; with async_write the file is written by a background thread
+    while training goes on (a single write in flight, the next save waits for it)
+    :param path: checkpoint file
+    :param async_write: write the file in a background thread
+    """
+
+    def __init__(self, path, async_write=False):
+        self.path = path
+        self.async_write = async_write
+        self.thread = None
+        self.error = None
+
+    def save(self, state):
+        buffer = io.BytesIO()
+        torch.save(state, buffer)
+        self.wait()
+        if self.async_write:
+            self.thread = threading.Thread(target=self.write, args=(buffer.getvalue(),), daemon=True)
+            self.thread.start()
+        else:
+            self.write(buffer.getvalue())
+
+    def write(self, data):
+        try:
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            if not self.async_write:
+                raise
+            self.error = e
+
+    def wait(self):
+        """
+        Waits for the write in flight, raising its error if it failed
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def load_checkpoint(path, map_location=None):
+    return torch.load(path, map_location=map_location)
+
+
+def rng_state():
+    """
+    States of the python, numpy and torch (CPU and CUDA) random generators
+    """
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and len(state['cuda']) > 0:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def experience_state(strategy, experience, stage, accuracy_history):
+    """
+    Checkpoint of a run after the evaluation (stage 'evaluated') or the basis update (stage 'basis') of experience
+    """
+    return {'experience': experience, 'stage': stage, 'strategy': strategy.state_dict(),
+            'accuracy_history': accuracy_history, 'rng': rng_state(), 'run_id': mlflow.active_run().info.run_id}
+
+
+def resume_point(checkpoint):
+    """
+    First experience to run after checkpoint, and whether its training and evaluation are already done (only the basis
+    update is left)
+    """
+    if checkpoint['stage'] == 'evaluated':
+        return checkpoint['experience'], True
+    return checkpoint['experience'] + 1, False
+
+
+def log_run_params(params):
+    """
+    Logs the params to the active mlflow run. A resumed run already has the params it was started with, and mlflow
+    refuses to change a logged param (resume, save_path, ...): only the params it does not have yet are logged
+    """
+    logged = mlflow.get_run(mlflow.active_run().info.run_id).data.params
+    for key, value in params.items():
+        if key not in logged:
+            mlflow.log_param(key, value)
@@ -6,48 +6,50 @@ from torchvision import datasets,transforms
 from sklearn.utils import shuffle
 
 cf100_dir = './Datasets/'
-file_dir = './Datasets/binary_cifar100'
+# Raw uint8 cache (data<t><split>x.npy, data<t><split>y.npy), memory-mapped when loaded and normalized on the fly
+file_dir = './Datasets/cifar100_uint8'
+
+mean=[x/255 for x in [125.3,123.0,113.9]]
+std=[x/255 for x in [63.0,62.1,66.7]]
+
+
+def normalize(x):
+    """
+    uint8 images (...,3,32,32) to normalized float32 images, on the device of x (same values as ToTensor + Normalize)
+    """
+    x=x.float().div_(255)
+    x=x.sub_(torch.tensor(mean,device=x.device).view(-1,1,1)).div_(torch.tensor(std,device=x.device).view(-1,1,1))
+    return x
+
+
+def cache_path(t,s,name):
+    return os.path.join(os.path.expanduser(file_dir),'data'+str(t)+s+name+'.npy')
+
 
 def get(seed=0,pc_valid=0.10):
     data={}
     taskcla=[]
     size=[3,32,32]
 
-    if not os.path.isdir(file_dir):
-        os.makedirs(file_dir)
+    if not all(os.path.isfile(cache_path(t,s,name)) for t in range(10) for s in ['train','test'] for name in ['x','y']):
+        os.makedirs(file_dir,exist_ok=True)
 
-        mean=[x/255 for x in [125.3,123.0,113.9]]
-        std=[x/255 for x in [63.0,62.1,66.7]]
-
-        # CIFAR100
-        dat={}
-        dat['train']=datasets.CIFAR100(cf100_dir,train=True,download=True,transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-        dat['test']=datasets.CIFAR100(cf100_dir,train=False,download=True,transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-        # dat['train'] = datasets.CIFAR100(cf100_dir,train=True,download=False,transform=transforms.Compose([transforms.ToTensor()]))
-        # dat['test']  = datasets.CIFAR100(cf100_dir,train=False,download=False,transform=transforms.Compose([transforms.ToTensor()]))
-        for n in range(10):
-            data[n]={}
-            data[n]['name']='cifar100'
-            data[n]['ncla']=10
-            data[n]['train']={'x': [],'y': []}
-            data[n]['test']={'x': [],'y': []}
+        # CIFAR100, written in one vectorized pass (task = label//10, in the order of the dataset)
         for s in ['train','test']:
-            loader=torch.utils.data.DataLoader(dat[s],batch_size=1,shuffle=False)
-            for image,target in loader:
-                n=target.numpy()[0]
-                nn=(n//10)
-                data[nn][s]['x'].append(image) # 255
-                data[nn][s]['y'].append(n%10)
-
-        # "Unify" and save
-        for t in data.keys():
-            for s in ['train','test']:
-                data[t][s]['x']=torch.stack(data[t][s]['x']).view(-1,size[0],size[1],size[2])
-                data[t][s]['y']=torch.LongTensor(np.array(data[t][s]['y'],dtype=int)).view(-1)
-                torch.save(data[t][s]['x'], os.path.join(os.path.expanduser(file_dir),'data'+str(t)+s+'x.bin'))
-                torch.save(data[t][s]['y'], os.path.join(os.path.expanduser(file_dir),'data'+str(t)+s+'y.bin'))
+            dat=datasets.CIFAR100(cf100_dir,train=s=='train',download=True)
+            x=dat.data.transpose(0,3,1,2)
+            y=np.array(dat.targets,dtype=np.int64)
+            for t in range(10):
+                idx=np.flatnonzero(y//10==t)
+                for name,array in [('x',x[idx]),('y',y[idx]%10)]:
+                    out=np.lib.format.open_memmap(cache_path(t,s,name)+'.tmp',mode='w+',dtype=array.dtype,
+                                                  shape=array.shape)
+                    out[:]=array
+                    out.flush()
+                    del out
+                    os.replace(cache_path(t,s,name)+'.tmp',cache_path(t,s,name))
 
-    # Load binary files
+    # Load the memory-mapped files (copy-on-write, shared read-only pages)
     data={}
     # ids=list(shuffle(np.arange(5),random_state=seed))
     ids=list(np.arange(10))
@@ -56,15 +58,15 @@ def get(seed=0,pc_valid=0.10):
         data[i] = dict.fromkeys(['name','ncla','train','test'])
         for s in ['train','test']:
             data[i][s]={'x':[],'y':[]}
-            data[i][s]['x']=torch.load(os.path.join(os.path.expanduser(file_dir),'data'+str(ids[i])+s+'x.bin'))
-            data[i][s]['y']=torch.load(os.path.join(os.path.expanduser(file_dir),'data'+str(ids[i])+s+'y.bin'))
+            data[i][s]['x']=torch.from_numpy(np.load(cache_path(ids[i],s,'x'),mmap_mode='c'))
+            data[i][s]['y']=torch.from_numpy(np.load(cache_path(ids[i],s,'y')))
         data[i]['ncla']=len(np.unique(data[i]['train']['y'].numpy()))
         if data[i]['ncla']==2:
             data[i]['name']='cifar10-'+str(ids[i])
         else:
             data[i]['name']='cifar100-'+str(ids[i])
 
-    # Validation
+    # Validation (a single uint8 gather of each split, the images stay unnormalized)
     for t in data.keys():
         r=np.arange(data[t]['train']['x'].size(0))
         r=np.array(shuffle(r,random_state=seed),dtype=int)
@@ -72,10 +74,10 @@ def get(seed=0,pc_valid=0.10):
         ivalid=torch.LongTensor(r[:nvalid])
         itrain=torch.LongTensor(r[nvalid:])
         data[t]['valid']={}
-        data[t]['valid']['x']=data[t]['train']['x'][ivalid].clone()
-        data[t]['valid']['y']=data[t]['train']['y'][ivalid].clone()
-        data[t]['train']['x']=data[t]['train']['x'][itrain].clone()
-        data[t]['train']['y']=data[t]['train']['y'][itrain].clone()
+        data[t]['valid']['x']=data[t]['train']['x'][ivalid]
+        data[t]['valid']['y']=data[t]['train']['y'][ivalid]
+        data[t]['train']['x']=data[t]['train']['x'][itrain]
+        data[t]['train']['y']=data[t]['train']['y'][itrain]
 
     # Others
     n=0
@@ -84,4 +86,4 @@ def get(seed=0,pc_valid=0.10):
         n+=data[t]['ncla']
     data['ncla']=n
 
-    return data,taskcla,size
\ No newline at end of file
+    return data,taskcla,size
@@ -0,0 +1,213 @@
+import torch
+from collections import OrderedDict
+from torch.utils.data import DataLoader
+
+__all__ = ["DeviceTensorDataset", "DeviceDataLoader", "DevicePrefetcher", "DataLoaderManager", "make_data_loader",
+           "tensor_experience", "BatchAugment"]
+
+
+class DeviceTensorDataset(object):
+    """
+    Task held as tensors moved once to the device, iterated by DeviceDataLoader without workers nor collation
+    :param tensors: tensors with the samples along the first dimension (e.g. x, y)
+    :param device: device the tensors are moved to
+    :param transform: applied on the device to each batch of the first tensor (e.g. normalization of uint8 images)
+    """
+
+    def __init__(self, *tensors, device='cuda', transform=None):
+        self.tensors = [tensor.to(device) for tensor in tensors]
+        self.device = self.tensors[0].device
+        self.transform = transform
+
+    def __len__(self):
+        return self.tensors[0].size(0)
+
+    def __getitem__(self, index):
+        return self.batch([tensor[index] for tensor in self.tensors])
+
+    def batch(self, tensors):
+        if self.transform is not None:
+            tensors[0] = self.transform(tensors[0])
+        return tensors
+
+
+class DeviceDataLoader(object):
+    """
+    Batches of a DeviceTensorDataset by slicing, shuffled with an on-device permutation at every iteration
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.dataset)
+        permutation = torch.randperm(n, device=self.dataset.device) if self.shuffle else None
+        for start in range(0, n, self.batch_size):
+            if permutation is None:
+                yield self.dataset.batch([tensor[start:start + self.batch_size] for tensor in self.dataset.tensors])
+            else:
+                index = permutation[start:start + self.batch_size]
+                yield self.dataset.batch([tensor[index] for tensor in self.dataset.tensors])
+
+
+class DevicePrefetcher(object):
+    """
+    Iterates a loader of host (pinned) batches, copying the next batch to the CUDA device on a side stream while the
+    current one is used
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _load(self, iterator, stream):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return [tensor.to(self.device, non_blocking=True) if torch.is_tensor(tensor) else tensor
+                    for tensor in batch]
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.loader)
+        next_batch = self._load(iterator, stream)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for tensor in batch:
+                if torch.is_tensor(tensor):
+                    tensor.record_stream(current_stream)
+            next_batch = self._load(iterator, stream)
+            yield batch
+
+
+class DataLoaderManager(object):
+    """
+    Keeps the DataLoader of each (dataset, batch size, shuffle) with persistent workers, so that the worker pools are
+    reused across epochs and phases (training, testing, conceptor computation). On CUDA the batches are pinned and
+    prefetched by a DevicePrefetcher. The loaders of a finished experience are released with release, and the least
+    recently used loaders (and their workers) beyond max_loaders are released
+    :param device: device the batches are used on
+    :param num_workers: workers of each DataLoader
+    :param max_loaders: number of loaders kept
+    """
+
+    def __init__(self, device, num_workers=4, max_loaders=8):
+        self.device = torch.device(device)
+        self.num_workers = num_workers
+        self.max_loaders = max_loaders
+        self.loaders = OrderedDict()
+
+    def prefetch(self, loader):
+        return DevicePrefetcher(loader, self.device) if self.device.type == 'cuda' else loader
+
+    def get(self, dataset, batch_size, shuffle=False):
+        if isinstance(dataset, DeviceTensorDataset):
+            return DeviceDataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+        key = (id(dataset), batch_size, shuffle)
+        # The dataset is kept with its loader so that its id is not reused
+        entry = self.loaders.pop(key, None)
+        if entry is None:
+            entry = (dataset, make_data_loader(dataset, batch_size, shuffle=shuffle, num_workers=self.num_workers,
+                                               pin_memory=self.device.type == 'cuda',
+                                               persistent_workers=self.num_workers > 0))
+        self.loaders[key] = entry
+        while len(self.loaders) > self.max_loaders:
+            self.loaders.popitem(last=False)
+        return self.prefetch(entry[1])
+
+    def release(self, dataset, batch_size=None):
+        """
+        Releases the loaders of dataset (only the one of batch_size if given) and shuts their workers down
+        """
+        for key in [key for key in self.loaders if key[0] == id(dataset) and batch_size in (None, key[1])]:
+            del self.loaders[key]
+
+    def clear(self):
+        self.loaders.clear()
+
+
+class BatchAugment(object):
+    """
+    RandomCrop (with zero padding), RandomHorizontalFlip and RandomErasing applied to a whole batch on its device, with
+    the random parameters of each sample drawn at once (same distributions as the torchvision transforms)
+    :param padding: padding of the random crop (no crop when 0)
+    :param fill: per-channel value of the padding, e.g. the normalized value of a black pixel (0 by default)
+    :param flip: probability of the horizontal flip
+    :param erasing: probability of the random erasing (erased with zeros)
+    :param scale: range of the erased area, relative to the image
+    :param ratio: range of the aspect ratio of the erased area
+    """
+
+    def __init__(self, padding=4, fill=None, flip=0.5, erasing=0.0, scale=(0.02, 0.33), ratio=(0.3, 3.3)):
+        self.padding = padding
+        self.fill = fill
+        self.flip = flip
+        self.erasing = erasing
+        self.scale = scale
+        self.ratio = ratio
+
+    def __call__(self, x):
+        n, c, h, w = x.shape
+        device = x.device
+        if self.padding > 0:
+            p = self.padding
+            padded = x.new_zeros(n, c, h + 2 * p, w + 2 * p)
+            if self.fill is not None:
+                padded += torch.tensor(self.fill, dtype=x.dtype, device=device).view(-1, 1, 1)
+            padded[:, :, p:p + h, p:p + w] = x
+            top = torch.randint(0, 2 * p + 1, (n, 1, 1), device=device)
+            left = torch.randint(0, 2 * p + 1, (n, 1, 1), device=device)
+            rows = (top + torch.arange(h, device=device).view(1, -1, 1)).expand(n, h, w)
+            cols = (left + torch.arange(w, device=device).view(1, 1, -1)).expand(n, h, w)
+            index = (rows * (w + 2 * p) + cols).view(n, 1, h * w).expand(n, c, h * w)
+            x = padded.view(n, c, -1).gather(2, index).view(n, c, h, w)
+        if self.flip > 0:
+            flipped = torch.rand(n, device=device) < self.flip
+            x = torch.where(flipped.view(-1, 1, 1, 1), x.flip(-1), x)
+        if self.erasing > 0:
+            # As torchvision, the first of 10 attempts that fits in the image is used (no erasing if none fits)
+            area = h * w * torch.empty(n, 10, device=device).uniform_(*self.scale)
+            log_ratio = torch.empty(n, 10, device=device).uniform_(*torch.tensor(self.ratio).log().tolist())
+            eh = (area * log_ratio.exp()).sqrt().round().long()
+            ew = (area / log_ratio.exp()).sqrt().round().long()
+            fits = (eh < h) & (ew < w)
+            attempt = fits.long().argmax(1, keepdim=True)
+            eh, ew = eh.gather(1, attempt), ew.gather(1, attempt)
+            erased = (torch.rand(n, 1, device=device) < self.erasing) & fits.any(1, keepdim=True)
+            top = (torch.rand(n, 1, device=device) * (h - eh + 1)).long()
+            left = (torch.rand(n, 1, device=device) * (w - ew + 1)).long()
+            rows = torch.arange(h, device=device).view(1, -1)
+            cols = torch.arange(w, device=device).view(1, -1)
+            mask = (((rows >= top) & (rows < top + eh)).view(n, h, 1)
+                    & ((cols >= left) & (cols < left + ew)).view(n, 1, w) & erased.view(n, 1, 1))
+            x = x.masked_fill(mask.unsqueeze(1), 0)
+        return x
+
+
+def make_data_loader(dataset, batch_size, shuffle=False, num_workers=4, **kwargs):
+    """
+    DeviceDataLoader for a DeviceTensorDataset, DataLoader otherwise
+    """
+    if isinstance(dataset, DeviceTensorDataset):
+        return DeviceDataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+    return DataLoader(dataset, num_workers=num_workers, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+
+def tensor_experience(x, y, device='cpu', transform=None):
+    """
+    Experience made of the tensors x, y: a DeviceTensorDataset on device, with transform applied to each batch (on the
+    host with the default 'cpu', the uint8 samples are only converted batch by batch)
+    """
+    return DeviceTensorDataset(x, y, device=device, transform=transform)
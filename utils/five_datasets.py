@@ -1,9 +1,12 @@
 ### This file is modified from : https://github.com/joansj/hat/blob/master/src/dataloaders/mixture.py
 import os,sys
 import os.path
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import torch
 import torch.utils.data
+import torch.nn.functional as F
 from torchvision import datasets,transforms
 from sklearn.utils import shuffle
 import urllib.request
@@ -14,6 +17,94 @@ import pickle
 __all__ = ["get_5datasets"]
 ########################################################################################################################
 
+# Raw uint8 cache (data<idx><split>x.npy, data<idx><split>y.npy): grayscale images keep a single channel and their
+# original size, the padding to 32x32, the normalization and the 3 channels are applied by normalize on the device
+file_dir='./Datasets/five_datasets_uint8'
+
+# name, number of classes, mean and std (of the padded images for MNIST and FashionMNIST)
+sources=[
+    ('cifar10',10,[x/255 for x in [125.3,123.0,113.9]],[x/255 for x in [63.0,62.1,66.7]]),
+    # ('cifar100',100,[x/255 for x in [125.3,123.0,113.9]],[x/255 for x in [63.0,62.1,66.7]]),
+    ('mnist',10,(0.1,),(0.2752,)), # Without the padding: (0.1307,), (0.3081,)
+    ('svhn',10,[0.4377,0.4438,0.4728],[0.198,0.201,0.197]),
+    ('fashion-mnist',10,(0.2190,),(0.3318,)),
+    ('notmnist',10,(0.4254,),(0.4501,)),
+    # ('traffic-signs',43,[0.3398,0.3117,0.3210],[0.2755,0.2647,0.2712]),
+    # ('facescrub',100,[0.5163,0.5569,0.4695],[0.2307,0.2272,0.2479]),
+]
+
+
+def normalize(x,mean,std,size=32):
+    """
+    uint8 images (...,C,H,W) to normalized float32 images (...,3,size,size), on the device of x (same values as Pad,
+    ToTensor, Normalize and the expansion of the grayscale images to 3 channels)
+    """
+    x=x.float().div_(255)
+    pad=(size-x.size(-1))//2
+    if pad>0:
+        x=F.pad(x,(pad,pad,pad,pad))
+    x=x.sub_(torch.tensor(mean,device=x.device).view(-1,1,1)).div_(torch.tensor(std,device=x.device).view(-1,1,1))
+    return x.expand(*x.shape[:-3],3,size,size)
+
+
+def cache_path(idx,s,name):
+    return os.path.join(os.path.expanduser(file_dir),'data'+str(idx)+s+name+'.npy')
+
+
+def save(path,array):
+    """
+    Writes array to the .npy file path through a temporary file, so that an interrupted build leaves no partial file
+    """
+    out=np.lib.format.open_memmap(path+'.tmp',mode='w+',dtype=array.dtype,shape=array.shape)
+    out[:]=array
+    out.flush()
+    del out
+    os.replace(path+'.tmp',path)
+
+
+def load_source(idx,s):
+    """
+    Images (N,C,H,W) as uint8 and labels of the split s of the source dataset idx, without decoding them one by one
+    """
+    train=s=='train'
+    if idx==0:
+        # CIFAR10
+        dat=datasets.CIFAR10('./Datasets',train=train,download=True)
+        x,y=dat.data.transpose(0,3,1,2),dat.targets
+    elif idx==1:
+        # MNIST
+        dat=datasets.MNIST('./Datasets',train=train,download=True)
+        x,y=dat.data.numpy()[:,None],dat.targets.numpy()
+    elif idx==2:
+        # SVHN
+        dat=datasets.SVHN('./Datasets',split=s,download=True)
+        x,y=dat.data,dat.labels
+    elif idx==3:
+        # FashionMNIST
+        dat=FashionMNIST('./Datasets/fashion_mnist',train=train,download=True)
+        x,y=dat.data.numpy()[:,None],dat.targets.numpy()
+    elif idx==4:
+        # notMNIST A-J letters
+        dat=notMNIST('./Datasets/notmnist',train=train,download=True)
+        x,y=dat.data,dat.labels
+    else:
+        print('ERROR: Undefined data set',idx)
+        sys.exit()
+    return np.ascontiguousarray(x,dtype=np.uint8),np.array(y,dtype=np.int64)
+
+
+def build_source(idx):
+    """
+    Writes the splits of the source dataset idx missing from the cache (run in its own process by get_5datasets)
+    """
+    for s in ['train','test']:
+        if not (os.path.isfile(cache_path(idx,s,'x')) and os.path.isfile(cache_path(idx,s,'y'))):
+            x,y=load_source(idx,s)
+            save(cache_path(idx,s,'y'),y)
+            save(cache_path(idx,s,'x'),x)
+    return idx
+
+
 def get_5datasets(seed=1,fixed_order=False,pc_valid=0.05):
     data={}
     taskcla=[]
@@ -24,207 +115,29 @@ def get_5datasets(seed=1,fixed_order=False,pc_valid=0.05):
     #     idata=list(shuffle(idata,random_state=seed))
     print('Task order =',idata)
 
-    if not os.path.isdir('./Datasets/binary_mixture_5_Data/'):
-        os.makedirs('./Datasets/binary_mixture_5_Data')
-        # Pre-load
-        for n,idx in enumerate(idata):
-            if idx==0:
-                # CIFAR10
-                mean=[x/255 for x in [125.3,123.0,113.9]]
-                std=[x/255 for x in [63.0,62.1,66.7]]
-                dat={}
-                dat['train']=datasets.CIFAR10('./Datasets',train=True,download=True,transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-                dat['test']=datasets.CIFAR10('./Datasets',train=False,download=True,transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-                data[n]={}
-                data[n]['name']='cifar10'
-                data[n]['ncla']=10
-                for s in ['train','test']:
-                    loader=torch.utils.data.DataLoader(dat[s],batch_size=1,shuffle=False)
-                    data[n][s]={'x': [],'y': []}
-                    for image,target in loader:
-                        data[n][s]['x'].append(image)
-                        data[n][s]['y'].append(target.numpy()[0])
-
-            # elif idx==1:
-            #     # CIFAR100
-            #     mean=[x/255 for x in [125.3,123.0,113.9]]
-            #     std=[x/255 for x in [63.0,62.1,66.7]]
-            #     dat={}
-            #     dat['train']=datasets.CIFAR100('../dat/',train=True,download=True,transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-            #     dat['test']=datasets.CIFAR100('../dat/',train=False,download=True,transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-            #     data[n]={}
-            #     data[n]['name']='cifar100'
-            #     data[n]['ncla']=100
-            #     for s in ['train','test']:
-            #         loader=torch.utils.data.DataLoader(dat[s],batch_size=1,shuffle=False)
-            #         data[n][s]={'x': [],'y': []}
-            #         for image,target in loader:
-            #             data[n][s]['x'].append(image)
-            #             data[n][s]['y'].append(target.numpy()[0])
-
-            elif idx==1:
-                # MNIST
-                #mean=(0.1307,) # Mean and std without including the padding
-                #std=(0.3081,)
-                mean=(0.1,) # Mean and std including the padding
-                std=(0.2752,)
-                dat={}
-                dat['train']=datasets.MNIST('./Datasets',train=True,download=True,transform=transforms.Compose([
-                    transforms.Pad(padding=2,fill=0),transforms.ToTensor(),transforms.Normalize(mean,std)]))
-                dat['test']=datasets.MNIST('./Datasets',train=False,download=True,transform=transforms.Compose([
-                    transforms.Pad(padding=2,fill=0),transforms.ToTensor(),transforms.Normalize(mean,std)]))
-                data[n]={}
-                data[n]['name']='mnist'
-                data[n]['ncla']=10
-                for s in ['train','test']:
-                    loader=torch.utils.data.DataLoader(dat[s],batch_size=1,shuffle=False)
-                    data[n][s]={'x': [],'y': []}
-                    for image,target in loader:
-                        image=image.expand(1,3,image.size(2),image.size(3)) # Create 3 equal channels
-                        data[n][s]['x'].append(image)
-                        data[n][s]['y'].append(target.numpy()[0])
-
-            elif idx == 2:
-                # SVHN
-                mean=[0.4377,0.4438,0.4728]
-                std=[0.198,0.201,0.197]
-                dat = {}
-                dat['train']=datasets.SVHN('./Datasets',split='train',download=True,transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-                dat['test']=datasets.SVHN('./Datasets',split='test',download=True,transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-                data[n] = {}
-                data[n]['name']='svhn'
-                data[n]['ncla']=10
-                for s in ['train','test']:
-                    loader = torch.utils.data.DataLoader(dat[s], batch_size=1, shuffle=False)
-                    data[n][s] = {'x': [], 'y': []}
-                    for image, target in loader:
-                        data[n][s]['x'].append(image)
-                        data[n][s]['y'].append(target.numpy()[0])
-
-            elif idx == 3:
-                # FashionMNIST
-                mean=(0.2190,) # Mean and std including the padding
-                std=(0.3318,)
-                dat={}
-                dat['train']=FashionMNIST('./Datasets/fashion_mnist', train=True, download=True, transform=transforms.Compose([
-                    transforms.Pad(padding=2, fill=0), transforms.ToTensor(),transforms.Normalize(mean, std)]))
-                dat['test']=FashionMNIST('./Datasets/fashion_mnist', train=False, download=True, transform=transforms.Compose([
-                    transforms.Pad(padding=2, fill=0), transforms.ToTensor(),transforms.Normalize(mean, std)]))
-                data[n]={}
-                data[n]['name']='fashion-mnist'
-                data[n]['ncla']=10
-                for s in ['train','test']:
-                    loader=torch.utils.data.DataLoader(dat[s], batch_size=1, shuffle=False)
-                    data[n][s]={'x': [], 'y': []}
-                    for image,target in loader:
-                        image=image.expand(1, 3, image.size(2), image.size(3))  # Create 3 equal channels
-                        data[n][s]['x'].append(image)
-                        data[n][s]['y'].append(target.numpy()[0])
-
-            # elif idx == 5:
-            #     # Traffic signs
-            #     mean=[0.3398,0.3117,0.3210]
-            #     std=[0.2755,0.2647,0.2712]
-            #     dat={}
-            #     dat['train']=TrafficSigns('../dat/traffic_signs', train=True, download=True, transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-            #     dat['test']=TrafficSigns('../dat/traffic_signs', train=False, download=True, transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-            #     # mean, var = utils.compute_mean_std_dataset(dat['train'])
-            #     data[n]={}
-            #     data[n]['name']='traffic-signs'
-            #     data[n]['ncla']=43
-            #     for s in ['train','test']:
-            #         loader = torch.utils.data.DataLoader(dat[s], batch_size=1, shuffle=False)
-            #         data[n][s] = {'x': [], 'y': []}
-            #         for image, target in loader:
-            #             data[n][s]['x'].append(image)
-            #             data[n][s]['y'].append(target.numpy()[0])
-            # elif idx == 6:
-            #     # Facescrub 100 faces
-            #     mean=[0.5163,0.5569,0.4695]
-            #     std=[0.2307,0.2272,0.2479]
-            #     dat={}
-            #     dat['train']=Facescrub('../dat/facescrub', train=True, download=True, transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-            #     dat['test']=Facescrub('../dat/facescrub', train=False, download=True, transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-            #     #mean, std = utils.compute_mean_std_dataset(dat['train']); print(mean,std); sys.exit()
-            #     data[n]={}
-            #     data[n]['name']='facescrub'
-            #     data[n]['ncla']=100
-            #     for s in ['train','test']:
-            #         loader = torch.utils.data.DataLoader(dat[s], batch_size=1, shuffle=False)
-            #         data[n][s] = {'x': [], 'y': []}
-            #         for image, target in loader:
-            #             data[n][s]['x'].append(image)
-            #             data[n][s]['y'].append(target.numpy()[0])
-            elif idx == 4:
-                # notMNIST A-J letters
-                mean=(0.4254,)
-                std=(0.4501,)
-                dat={}
-                dat['train']=notMNIST('./Datasets/notmnist', train=True, download=True, transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-                dat['test']=notMNIST('./Datasets/notmnist', train=False, download=True, transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-                #mean, std = utils.compute_mean_std_dataset(dat['train']); print(mean,std); sys.exit()
-                data[n]={}
-                data[n]['name']='notmnist'
-                data[n]['ncla']=10
-                for s in ['train','test']:
-                    loader = torch.utils.data.DataLoader(dat[s], batch_size=1, shuffle=False)
-                    data[n][s] = {'x': [], 'y': []}
-                    for image, target in loader:
-                        image=image.expand(1,3,image.size(2),image.size(3))
-                        data[n][s]['x'].append(image)
-                        data[n][s]['y'].append(target.numpy()[0])
-            else:
-                print('ERROR: Undefined data set',n)
-                sys.exit()
-            #print(n,data[n]['name'],data[n]['ncla'],len(data[n]['train']['x']))
-
-            # "Unify" and save
-            for s in ['train','test']:
-                data[n][s]['x']=torch.stack(data[n][s]['x']).view(-1,size[0],size[1],size[2])
-                data[n][s]['y']=torch.LongTensor(np.array(data[n][s]['y'],dtype=int)).view(-1)
-                torch.save(data[n][s]['x'], os.path.join(os.path.expanduser('./Datasets/binary_mixture_5_Data'),'data'+str(idx)+s+'x.bin'))
-                torch.save(data[n][s]['y'], os.path.join(os.path.expanduser('./Datasets/binary_mixture_5_Data'),'data'+str(idx)+s+'y.bin'))
-
-    else:
-
-        # Load binary files
-        for n,idx in enumerate(idata):
-            data[n] = dict.fromkeys(['name','ncla','train','test'])
-            if idx==0:
-                data[n]['name']='cifar10'
-                data[n]['ncla']=10
-            # elif idx==1:
-            #     data[n]['name']='cifar100'
-            #     data[n]['ncla']=100
-            elif idx==1:
-                data[n]['name']='mnist'
-                data[n]['ncla']=10
-            elif idx==2:
-                data[n]['name']='svhn'
-                data[n]['ncla']=10
-            elif idx==3:
-                data[n]['name']='fashion-mnist'
-                data[n]['ncla']=10
-            # elif idx==5:
-            #     data[n]['name']='traffic-signs'
-            #     data[n]['ncla']=43
-            # elif idx==6:
-            #     data[n]['name']='facescrub'
-            #     data[n]['ncla']=100
-            elif idx==4:
-                data[n]['name']='notmnist'
-                data[n]['ncla']=10
-            else:
-                print('ERROR: Undefined data set',n)
-                sys.exit()
-
-            # Load
-            for s in ['train','test']:
-                data[n][s]={'x':[],'y':[]}
-                data[n][s]['x'] = torch.load(os.path.join(os.path.expanduser('./Datasets/binary_mixture_5_Data'),'data'+str(idx)+s+'x.bin'))
-                data[n][s]['y'] = torch.load(os.path.join(os.path.expanduser('./Datasets/binary_mixture_5_Data'),'data'+str(idx)+s+'y.bin'))
-
-    # Validation
+    # Pre-load the datasets missing from the cache, one process per dataset (an interrupted build resumes from the
+    # splits already written)
+    os.makedirs(file_dir,exist_ok=True)
+    missing=[idx for idx in idata for s in ['train','test']
+             if not (os.path.isfile(cache_path(idx,s,'x')) and os.path.isfile(cache_path(idx,s,'y')))]
+    missing=sorted(set(missing))
+    if len(missing)>0:
+        with ProcessPoolExecutor(len(missing)) as pool:
+            list(pool.map(build_source,missing))
+
+    # Load the memory-mapped files (copy-on-write, shared read-only pages)
+    for n,idx in enumerate(idata):
+        name,ncla,mean,std=sources[idx]
+        data[n]=dict.fromkeys(['name','ncla','train','test'])
+        data[n]['name']=name
+        data[n]['ncla']=ncla
+        data[n]['transform']=functools.partial(normalize,mean=mean,std=std,size=size[1])
+        for s in ['train','test']:
+            data[n][s]={'x':[],'y':[]}
+            data[n][s]['x']=torch.from_numpy(np.load(cache_path(idx,s,'x'),mmap_mode='c'))
+            data[n][s]['y']=torch.from_numpy(np.load(cache_path(idx,s,'y')))
+
+    # Validation (a single uint8 gather of each split, the images stay unnormalized)
     for t in data.keys():
         r=np.arange(data[t]['train']['x'].size(0))
         r=np.array(shuffle(r,random_state=seed),dtype=int)
@@ -232,10 +145,10 @@ def get_5datasets(seed=1,fixed_order=False,pc_valid=0.05):
         ivalid=torch.LongTensor(r[:nvalid])
         itrain=torch.LongTensor(r[nvalid:])
         data[t]['valid']={}
-        data[t]['valid']['x']=data[t]['train']['x'][ivalid].clone()
-        data[t]['valid']['y']=data[t]['train']['y'][ivalid].clone()
-        data[t]['train']['x']=data[t]['train']['x'][itrain].clone()
-        data[t]['train']['y']=data[t]['train']['y'][itrain].clone()
+        data[t]['valid']['x']=data[t]['train']['x'][ivalid]
+        data[t]['valid']['y']=data[t]['train']['y'][ivalid]
+        data[t]['train']['x']=data[t]['train']['x'][itrain]
+        data[t]['train']['y']=data[t]['train']['y'][itrain]
 
     # Others
     n=0
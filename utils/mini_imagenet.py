@@ -0,0 +1,118 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+from avalanche.benchmarks.datasets import MiniImageNetDataset
+from utils.device_data import tensor_experience
+
+__all__ = ["MiniImageNetShards"]
+
+# Normalization used by main.py for MiniImageNet
+mean = [x / 255 for x in [125.3, 123.0, 113.9]]
+std = [x / 255 for x in [63.0, 62.1, 66.7]]
+
+
+def normalize(x):
+    """
+    uint8 images (..., 3, H, W) to normalized float32 images, on the device of x (same values as ToTensor + Normalize)
+    """
+    x = x.float().div_(255)
+    x = x.sub_(torch.tensor(mean, device=x.device).view(-1, 1, 1))
+    return x.div_(torch.tensor(std, device=x.device).view(-1, 1, 1))
+
+
+def shard_path(root, shard):
+    return os.path.join(root, 'shard' + str(shard) + 'x.npy')
+
+
+def decode_shard(dataset, start, stop, path):
+    """
+    Decodes and resizes the images start:stop of dataset into the uint8 (N, H, W, 3) shard path, written through a
+    temporary file so that an interrupted conversion only redoes the missing shards
+    """
+    if os.path.isfile(path):
+        return
+    out = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.uint8,
+                                    shape=(stop - start,) + tuple(dataset.resize_to) + (3,))
+    for index in range(start, stop):
+        out[index - start] = np.asarray(dataset[index][0])
+    out.flush()
+    del out
+    os.replace(path + '.tmp', path)
+
+
+class MiniImageNetShards(Dataset):
+    """
+    MiniImageNetDataset decoded and resized (84x84) once into memory-mapped uint8 shards. The samples are in the order
+    of MiniImageNetDataset with the same targets, so random_split and nc_benchmark give the same splits and class order.
+    Samples are returned as PIL images built from a view of the shard, so the existing transforms are unchanged
+    :param imagenet_path: ImageNet 2012 folder given to MiniImageNetDataset, only read when the shards are missing
+    :param root: directory of the shards
+    :param shard_size: number of images of each shard
+    :param num_workers: processes decoding the shards in parallel (default: all cores)
+    """
+
+    def __init__(self, imagenet_path, root='./Datasets/mini_imagenet_uint8', shard_size=2500, num_workers=None):
+        targets_path = os.path.join(root, 'targets.npy')
+        if not os.path.isfile(targets_path):
+            self.convert(imagenet_path, root, shard_size, num_workers)
+        self.targets = np.load(targets_path).tolist()
+        self.shards = []
+        while sum(len(shard) for shard in self.shards) < len(self.targets):
+            self.shards.append(np.load(shard_path(root, len(self.shards)), mmap_mode='c'))
+        self.shard_size = len(self.shards[0])
+
+    @staticmethod
+    def convert(imagenet_path, root, shard_size=2500, num_workers=None):
+        """
+        One-time conversion of MiniImageNetDataset(imagenet_path) into the shards of root
+        """
+        os.makedirs(root, exist_ok=True)
+        dataset = MiniImageNetDataset(imagenet_path)
+        starts = list(range(0, len(dataset), shard_size))
+        stops = [min(start + shard_size, len(dataset)) for start in starts]
+        paths = [shard_path(root, shard) for shard in range(len(starts))]
+        with ProcessPoolExecutor(num_workers) as pool:
+            list(pool.map(decode_shard, [dataset] * len(starts), starts, stops, paths))
+        # The targets are written last, they mark a complete conversion
+        targets_path = os.path.join(root, 'targets.npy')
+        np.save(targets_path + '.tmp.npy', np.array(dataset.targets, dtype=np.int64))
+        os.replace(targets_path + '.tmp.npy', targets_path)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, item):
+        shard, offset = divmod(item, self.shard_size)
+        return Image.fromarray(self.shards[shard][offset]), self.targets[item]
+
+    def tensors(self, indices):
+        """
+        uint8 images (N, 3, H, W) of indices: a slice (view) of the memory-mapped shard when the indices are consecutive
+        within a shard, a single gather per shard otherwise
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        shard, offset = np.divmod(indices, self.shard_size)
+        if len(indices) > 0 and (shard == shard[0]).all() and (np.diff(offset) == 1).all():
+            x = self.shards[shard[0]][offset[0]:offset[-1] + 1]
+        else:
+            x = np.empty((len(indices),) + self.shards[0].shape[1:], dtype=np.uint8)
+            for k in np.unique(shard):
+                x[shard == k] = self.shards[k][offset[shard == k]]
+        return torch.from_numpy(x).permute(0, 3, 1, 2)
+
+    def experience(self, benchmark, subset, split, exp_id, device='cpu'):
+        """
+        Experience exp_id of the train or test stream (split) of benchmark, an nc_benchmark built on subset (a
+        random_split of this dataset), as uint8 tensors read in batches by a DeviceDataLoader and normalized per batch
+        on device. The samples, their order and the remapped targets are the ones of the benchmark experience
+        """
+        if split == 'train':
+            assignment = benchmark.train_exps_patterns_assignment[exp_id]
+        else:
+            assignment = benchmark.test_exps_patterns_assignment[exp_id]
+        indices = np.asarray(subset.indices, dtype=np.int64)[np.asarray(assignment, dtype=np.int64)]
+        targets = torch.tensor([benchmark.class_mapping[self.targets[index]] for index in indices])
+        return tensor_experience(self.tensors(indices), targets, device=device, transform=normalize)